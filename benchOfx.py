@@ -0,0 +1,200 @@
+#!/usr/bin/python
+#
+# Scaling benchmarks for importOfx.py. Generates synthetic statements
+# with genOfx.py and measures parsing (BeautifulSoup and the Ofx data
+# model) and importing into a fresh GnuCash book, reporting throughput
+# and peak memory. With -f the import goes into the in-memory book of
+# fakeGnucash.py, so it runs without GnuCash installed.
+#
+# Every case runs in its own process so peak RSS is per case.
+
+import os, sys, time
+import argparse
+import tempfile
+import shutil
+import hashlib
+import resource
+from decimal import Decimal
+from random import Random
+from multiprocessing import Process, Pipe
+
+import genOfx
+
+def countRecords(ofx):
+  transactions = ofx.stmtResponse.transactions
+  return len(transactions.investmentTransactions) + len(transactions.bankTransactions)
+
+def phaseTimings(stats):
+  return [(name, stats.phases[name]['wall']) for name in stats.phaseOrder]
+
+def dumpModel(value, OfxElement):
+  """Every field of Ofx model VALUE, so models built by different
+  parsers can be compared"""
+  if isinstance(value, OfxElement):
+    return '%s(%s)' % (value.__class__.__name__,
+                       ','.join(['%s=%s' % (c[0], dumpModel(getattr(value, c[0]), OfxElement))
+                                 for c in value.children if not isinstance(c, str)]))
+  if isinstance(value, list):
+    return '[%s]' % ','.join([dumpModel(v, OfxElement) for v in value])
+  return repr(value)
+
+def parseCase(ofxFileName, sgmlParser, mode):
+  import importOfx
+  importOfx.ofx_sgml_parser = sgmlParser
+  t0 = time.time()
+  ofx = importOfx.parseOfxFile(ofxFileName, useCache = False, mode = mode)
+  t1 = time.time()
+  return {'records': countRecords(ofx),
+          'timings': phaseTimings(importOfx.stats) + [('parse total', t1 - t0)],
+          'digest': hashlib.sha1(dumpModel(ofx, importOfx.OfxElement)).hexdigest()}
+
+def makeEmptyBook(gnuCashFileName):
+  """Create a book with the accounts importOfx.py expects to exist"""
+  import importOfx
+  session = importOfx.Session("xml://" + gnuCashFileName, True, True, True)
+  book = session.book
+  usd = book.get_table().lookup('CURRENCY', 'USD')
+  root = book.get_root_account()
+  importOfx.findOrMakeAccount(importOfx.brokerage_account_root.split(':'),
+                              root, book, usd, importOfx.ACCT_TYPE_BANK)
+  importOfx.findOrMakeAccount(('Equity', 'Opening Balances'),
+                              root, book, usd, importOfx.ACCT_TYPE_EQUITY)
+  session.save()
+  session.end()
+
+def importCase(ofxFileName, gnuCashFileName):
+  try:
+    import importOfx
+  except ImportError, e:
+    return {'skipped': 'no GnuCash bindings (%s), try -f' % e}
+  makeEmptyBook(gnuCashFileName)
+  stdout = sys.stdout
+  sys.stdout = open(os.devnull, 'w')
+  try:
+    t0 = time.time()
+    importOfx.doMain(gnuCashFileName, ofxFileName, True, False, useCache = False)
+    t1 = time.time()
+  finally:
+    sys.stdout = stdout
+  return {'records': countRecords(importOfx.ofx),
+          'timings': phaseTimings(importOfx.stats) + [('import total', t1 - t0)],
+          'counters': importOfx.stats.counters}
+
+def numericCase(count):
+  """COUNT conversions of amounts and prices from Decimal to
+  GncNumeric and back, some with denominators that are not powers of
+  ten, like a split's share price"""
+  try:
+    import importOfx
+  except ImportError, e:
+    return {'skipped': 'no GnuCash bindings (%s), try -f' % e}
+  random = Random(1)
+  decimals = [Decimal(random.randint(-10 ** 9, 10 ** 9)).scaleb(-random.choice((0, 2, 4, 6)))
+              for i in xrange(10000)]
+  numerics = [importOfx.gnc_numeric_from_decimal(d) for d in decimals] + \
+             [importOfx.GncNumeric(random.randint(-10 ** 9, 10 ** 9), random.choice((8, 40, 1024)))
+              for i in xrange(2000)]
+  fromDecimal = importOfx.gnc_numeric_from_decimal
+  toDecimal = importOfx.gnc_numeric_to_python_Decimal
+  t0 = time.time()
+  for i in xrange(count // len(decimals)):
+    for d in decimals:
+      fromDecimal(d)
+  t1 = time.time()
+  for i in xrange(count // len(numerics)):
+    for n in numerics:
+      toDecimal(n)
+  t2 = time.time()
+  return {'records': count,
+          'timings': [('Decimal to GncNumeric', t1 - t0),
+                      ('GncNumeric to Decimal', t2 - t1)]}
+
+def _child(conn, fn, args):
+  try:
+    result = fn(*args)
+  except Exception, e:
+    result = {'skipped': '%s: %s' % (e.__class__.__name__, e)}
+  result['peakKb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  conn.send(result)
+  conn.close()
+
+def runIsolated(fn, *args):
+  """Run FN(*ARGS) in a child process, return its result dict with
+  peak resident memory of the child added"""
+  parent, child = Pipe()
+  p = Process(target = _child, args = (child, fn, args))
+  p.start()
+  result = parent.recv()
+  p.join()
+  return result
+
+def printResult(records, case, result):
+  if result.has_key('skipped'):
+    print "%8d %-24s skipped (%s)" % (records, case, result['skipped'])
+    return
+  for name, seconds in result['timings']:
+    rate = seconds > 0 and result['records'] / seconds or 0
+    print "%8d %-24s %10.3f %12.0f" % (records, name, seconds, rate)
+  print "%8d %-24s %10s %12s %9.1f" % (records, case + ' peak memory', '', '',
+                                        result['peakKb'] / 1024.0)
+  if result.has_key('digest'):
+    print "%8d %-24s %s" % (records, 'model digest', result['digest'])
+  if result.has_key('counters'):
+    print "%8d %-24s %s" % (records, 'counters',
+                            ', '.join('%s=%d' % item for item in
+                                      sorted(result['counters'].items())))
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark importOfx.py parsing and import on synthetic statements")
+  parser.add_argument('-r', dest='sizes', default='1000,10000,100000', help='Comma separated list of statement sizes, in records')
+  parser.add_argument('-i', dest='doImport', action='store_true', help='Also benchmark importing into an empty GnuCash book')
+  parser.add_argument('-f', dest='fakeBook', action='store_true', help='Import into in-memory fakeGnucash book instead of real GnuCash')
+  parser.add_argument('--securities', type=int, default=50, help='Number of securities in generated statements')
+  parser.add_argument('--xml', action='store_true', help='Generate OFX 2.x XML statements')
+  parser.add_argument('--sgml', dest='closeElements', action='store_false', help='Generate statements with unclosed leaf elements, OFX 1.x style')
+  parser.add_argument('-p', dest='sgmlParsers', default='OfxSoup', help='Comma separated SGML parser classes to compare, OfxSoup and/or BeautifulSoup (which needs closed elements)')
+  parser.add_argument('-m', dest='modes', default='all', help='Comma separated import modes to parse for: all, prices, positions')
+  parser.add_argument('--lots', type=int, default=3, help='Positions per security')
+  parser.add_argument('--currency', metavar='<symbol>', help='Give bank transactions a CURRENCY aggregate, like some brokers do')
+  parser.add_argument('--numeric', dest='conversions', type=int, default=0, metavar='<count>', help='Also benchmark this many GncNumeric <-> Decimal conversions')
+  parser.add_argument('--keep', dest='keepDir', metavar='<dir>', help='Keep generated files in this directory')
+  args = parser.parse_args()
+  if args.fakeBook:
+    os.environ['GNUCASH_BINDINGS'] = 'fakeGnucash'
+
+  workDir = args.keepDir or tempfile.mkdtemp(prefix = 'benchOfx')
+  if not os.path.isdir(workDir):
+    os.makedirs(workDir)
+  try:
+    print "%8s %-24s %10s %12s %9s" % ('records', 'phase', 'seconds', 'records/s', 'peak MB')
+    for records in [int(size) for size in args.sizes.split(',') if size]:
+      ofxFileName = os.path.join(workDir, 'synthetic%d.ofx' % records)
+      out = open(ofxFileName, 'wb')
+      genOfx.generateStatement(out, securities = args.securities, lots = args.lots,
+                               xml = args.xml, closeElements = args.closeElements,
+                               currency = args.currency, **genOfx.recordCounts(records))
+      out.close()
+      for mode in args.modes.split(','):
+        for sgmlParser in args.sgmlParsers.split(','):
+          case = args.xml and 'parse' or 'parse ' + sgmlParser
+          if mode != 'all':
+            case += ' ' + mode
+          print "%8d %s" % (records, case)
+          printResult(records, case, runIsolated(parseCase, ofxFileName,
+                                                 sgmlParser, mode))
+          if args.xml:
+            break
+      if args.doImport:
+        gnuCashFileName = os.path.join(workDir, 'synthetic%d.gnucash' % records)
+        printResult(records, 'import', runIsolated(importCase, ofxFileName,
+                                                   gnuCashFileName))
+      sys.stdout.flush()
+    if args.conversions:
+      print "%8d numeric conversions" % args.conversions
+      printResult(args.conversions, 'numeric', runIsolated(numericCase, args.conversions))
+  finally:
+    if args.keepDir is None:
+      shutil.rmtree(workDir)
+
+if __name__ == "__main__":
+  main()
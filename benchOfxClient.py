@@ -0,0 +1,197 @@
+#!/usr/bin/python
+#
+# Benchmarks for the ofx.py download client: request construction,
+# connection reuse, concurrent batch downloads, chunked backfill and
+# retries. Everything runs against the local mock server from
+# mockOfxServer.py, so no bank is contacted.
+
+import os, sys, time
+import argparse
+import tempfile
+import shutil
+import subprocess
+
+import ofx
+import mockOfxServer
+
+def addMockSite(server, name = "mock"):
+    ofx.sites[name] = {"caps": ["SIGNON", "INVSTMT"],
+                       "fiorg": "mock.example",
+                       "url": server.url()}
+    if server.certfile is not None:
+        ofx.sites[name]["cafile"] = server.certfile
+    return name
+
+def makeCertificate(outDir):
+    """Self signed certificate for localhost, or None without openssl"""
+    certfile = os.path.join(outDir, "localhost.pem")
+    try:
+        subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048",
+                               "-nodes", "-days", "1", "-subj", "/CN=localhost",
+                               "-addext", "subjectAltName=DNS:localhost",
+                               "-keyout", certfile, "-out", certfile],
+                              stdout = open(os.devnull, "w"),
+                              stderr = subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return certfile
+
+def reuseBenchmark(args, outDir):
+    """Sequential queries of one client with and without keep-alive
+    connection reuse, over HTTP and HTTPS"""
+    certfile = makeCertificate(outDir)
+    print "connection reuse: %d sequential queries" % args.sequential
+    print "%-6s %-10s %10s %10s %12s" % ("scheme", "pool", "seconds", "ms/query", "connections")
+    for cert in [None] + (certfile and [certfile] or []):
+        server = mockOfxServer.startServer(certfile = cert)
+        site = addMockSite(server)
+        for pooled in (False, True):
+            connections = server.connections
+            client = ofx.OFXClient(dict(ofx.sites[site]), "user", "secret")
+            if not pooled:
+                client.pool = None
+            fileName = os.path.join(outDir, "reuse.ofx")
+            start = time.time()
+            for i in range(args.sequential):
+                client.doQuery(client.acctQuery("19700101000000"), fileName)
+            seconds = time.time() - start
+            print "%-6s %-10s %10.3f %10.2f %12d" % (
+                cert and "https" or "http", pooled and "keep-alive" or "none",
+                seconds, seconds * 1000 / args.sequential,
+                server.connections - connections)
+        ofx.connectionPool.closeAll()
+        server.shutdown()
+    if certfile is None:
+        print "(https skipped, openssl is not available to make a certificate)"
+
+def batchBenchmark(args, outDir):
+    """Same batch of downloads sequentially and with a thread pool"""
+    server = mockOfxServer.startServer(latency = args.latency)
+    site = addMockSite(server)
+    print "batch: %d jobs, server latency %.2fs" % (args.jobs, args.latency)
+    print "%8s %9s %10s %8s %6s" % ("workers", "per host", "seconds", "jobs/s", "ok")
+    for workers in (1, args.workers):
+        jobs = [ofx.BatchJob(site, "user%d" % i, "%08d" % i) for i in range(args.jobs)]
+        passwords = dict(((job.site, job.user), "secret") for job in jobs)
+        start = time.time()
+        ofx.runBatch(jobs, passwords, "20110101", "20110131", workers,
+                     args.perHost, outDir, open(os.devnull, "w"))
+        seconds = time.time() - start
+        ok = len([job for job in jobs if job.status == "OK"])
+        print "%8d %9d %10.3f %8.1f %6d" % (workers, args.perHost, seconds,
+                                             len(jobs) / seconds, ok)
+    ofx.connectionPool.closeAll()
+    server.shutdown()
+
+def backfillBenchmark(args, outDir):
+    """Two years of history in 90 day windows, one at a time and
+    concurrently"""
+    server = mockOfxServer.startServer(latency = args.latency, records = args.records)
+    site = addMockSite(server)
+    print "backfill: 20090101-20101231 in 90 day windows, %d transactions per 30 days" % args.records
+    print "%8s %10s %12s %14s" % ("workers", "seconds", "transactions", "transactions/s")
+    # the mock generates each statement once, keep that out of the timings
+    ofx.backfill(site, "user", "secret", "00000001", "20090101", "20101231",
+                 os.path.join(outDir, "backfill.ofx"), 90, args.workers,
+                 args.perHost, outDir = outDir, report = open(os.devnull, "w"))
+    for workers in (1, args.workers):
+        name = os.path.join(outDir, "backfill.ofx")
+        start = time.time()
+        count = ofx.backfill(site, "user", "secret", "00000001", "20090101",
+                             "20101231", name, 90, workers, args.perHost,
+                             outDir = outDir, report = open(os.devnull, "w"))
+        seconds = time.time() - start
+        print "%8d %10.3f %12d %14.0f" % (workers, seconds, count, count / seconds)
+    ofx.connectionPool.closeAll()
+    server.shutdown()
+
+def faultBenchmark(args, outDir):
+    """Retries against injected faults, and the per-host rate limit"""
+    print "faults: timeout 0.5s, backoff 0.05s, %d retries" % args.retries
+    print "%-10s %-8s %8s %10s  %s" % ("fault", "result", "attempts", "seconds", "error")
+    for fault in ("http503", "drop", "hang", "ofx2000", "ofx15500"):
+        server = mockOfxServer.startServer(faults = [fault] * 2, hang = 1.0)
+        site = addMockSite(server)
+        ofx.sites[site].update(timeout = 0.5, backoff = 0.05, retries = args.retries)
+        job = ofx.BatchJob(site, "user", "00000001")
+        job.run("secret", "20110101", "20110131", outDir)
+        print "%-10s %-8s %8d %10.3f  %s" % (fault, job.status, job.attempts,
+                                             job.seconds, job.error or "")
+        ofx.connectionPool.closeAll()
+        server.shutdown()
+
+    server = mockOfxServer.startServer(faultRate = args.faultRate,
+                                       faultKinds = ("http503", "drop", "ofx2000"))
+    site = addMockSite(server)
+    ofx.sites[site].update(backoff = 0.05, retries = args.retries)
+    jobs = [ofx.BatchJob(site, "user%d" % i, "%08d" % i) for i in range(args.jobs)]
+    passwords = dict(((job.site, job.user), "secret") for job in jobs)
+    ofx.runBatch(jobs, passwords, "20110101", "20110131", args.workers,
+                 args.perHost, outDir, open(os.devnull, "w"))
+    print "random faults in %.0f%% of requests: %d of %d jobs ok, %d faults, %d requests" % (
+        args.faultRate * 100, len([job for job in jobs if job.status == "OK"]),
+        len(jobs), server.faultsInjected, server.requests)
+
+    ofx.sites[site].update(rate = 20, burst = 1)
+    requests = server.requests
+    start = time.time()
+    ofx.runBatch(jobs, passwords, "20110101", "20110131", args.workers,
+                 args.perHost, outDir, open(os.devnull, "w"))
+    seconds = time.time() - start
+    print "rate limit 20/s: %d jobs in %.3fs, %.1f requests/s" % (
+        len(jobs), seconds, (server.requests - requests) / seconds)
+    ofx.connectionPool.closeAll()
+    server.shutdown()
+
+def sequentialUids():
+    """Deterministic request UIDs, for reproducible queries"""
+    counter = [0]
+    def uidgen():
+        counter[0] += 1
+        return "%032d" % counter[0]
+    return uidgen
+
+def queryBenchmark(args):
+    """Throughput of building INVSTMT requests, from scratch and from
+    the client's compiled templates"""
+    config = {"caps": ["SIGNON", "INVSTMT"], "fiorg": "mock.example",
+              "url": "http://localhost/"}
+    print "query construction: %d queries" % args.queries
+    print "%-12s %-10s %10s %10s" % ("uids", "templates", "seconds", "queries/s")
+    for name, uidgen in (("uuid4", ofx._genuuid), ("sequential", sequentialUids())):
+        for templates in (False, True):
+            client = ofx.OFXClient(dict(config), "user", "secret", uidgen)
+            if not templates:
+                client.templates = None
+            start = time.time()
+            for i in xrange(args.queries):
+                client.invstQuery("mock.example", "%08d" % i, "20110101", "20110131")
+            seconds = time.time() - start
+            print "%-12s %-10s %10.3f %10.0f" % (name, templates and "yes" or "no",
+                                                 seconds, args.queries / seconds)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ofx.py against a local mock OFX server")
+    parser.add_argument('-n', dest='jobs', type=int, default=16, help='Number of downloads in the batch')
+    parser.add_argument('-j', dest='workers', type=int, default=8, help='Concurrent downloads')
+    parser.add_argument('--per-host', dest='perHost', type=int, default=8, help='Max concurrent downloads from one server')
+    parser.add_argument('-l', dest='latency', type=float, default=0.2, help='Mock server latency in seconds')
+    parser.add_argument('-t', dest='records', type=int, default=1000, help='Transactions per 30 days in backfill statements')
+    parser.add_argument('-q', dest='queries', type=int, default=20000, help='Number of queries for the query construction benchmark')
+    parser.add_argument('-r', dest='retries', type=int, default=3, help='Retries for the fault benchmark')
+    parser.add_argument('-p', dest='faultRate', type=float, default=0.3, help='Fraction of requests failing in the fault benchmark')
+    parser.add_argument('-s', dest='sequential', type=int, default=50, help='Number of queries for the connection reuse benchmark')
+    args = parser.parse_args()
+
+    queryBenchmark(args)
+    outDir = tempfile.mkdtemp(prefix = "benchOfxClient")
+    try:
+        reuseBenchmark(args, outDir)
+        batchBenchmark(args, outDir)
+        backfillBenchmark(args, outDir)
+        faultBenchmark(args, outDir)
+    finally:
+        shutil.rmtree(outDir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,614 @@
+#!/usr/bin/python
+#
+# Pure Python, in-memory stand-in for the subset of the GnuCash python
+# bindings that importOfx.py uses: the account tree, commodity table,
+# price database, transactions, splits and lots.
+#
+# It lets the importer be exercised and benchmarked without a GnuCash
+# install or a book file:
+#
+#   ./benchOfx.py -i -f
+#
+# or importOfx.useBookBindings('fakeGnucash') and benchOfx.makeEmptyBook
+# from python.
+#
+# Books live only for the lifetime of the process. Session(url) opens
+# the book previously created for the same url, or a new one that has
+# just the root account and a few currencies. The importer also needs
+# the brokerage and Equity:Opening Balances accounts, which
+# makeEmptyBook adds, so importOfx.py on its own cannot use this.
+#
+# Behaviour that the importer depends on is mirrored from GnuCash
+# engine: unbalanced transactions get an Imbalance-CUR split on commit,
+# cash splits get amount = value, share prices are rounded to 6
+# significant digits, and ScrubGains assigns splits to lots FIFO,
+# splitting a split across lots when needed, and books the realized
+# gain to an Orphaned Gains-CUR account.
+
+from fractions import Fraction
+from itertools import count
+
+ACCT_TYPE_INVALID = -1
+ACCT_TYPE_NONE = -1
+ACCT_TYPE_BANK = 0
+ACCT_TYPE_CASH = 1
+ACCT_TYPE_ASSET = 2
+ACCT_TYPE_CREDIT = 3
+ACCT_TYPE_LIABILITY = 4
+ACCT_TYPE_STOCK = 5
+ACCT_TYPE_MUTUAL = 6
+ACCT_TYPE_CURRENCY = 7
+ACCT_TYPE_INCOME = 8
+ACCT_TYPE_EXPENSE = 9
+ACCT_TYPE_EQUITY = 10
+ACCT_TYPE_ROOT = 13
+
+currencies = ('USD', 'EUR', 'GBP', 'CAD', 'JPY', 'CHF')
+
+# significant digits GnuCash keeps in share prices
+PRICE_SIGFIGS = 6
+
+def _round(fraction, denom):
+  """Round FRACTION to a multiple of 1/DENOM, half away from zero"""
+  scaled = fraction * denom
+  num = (abs(scaled.numerator) * 2 + scaled.denominator) // (2 * scaled.denominator)
+  if scaled < 0:
+    num = -num
+  return Fraction(num, denom)
+
+def _numericAt(fraction, denom):
+  """FRACTION with denominator DENOM if it is exact, like amounts and
+  values that GnuCash keeps in commodity fraction units"""
+  if (fraction * denom).denominator == 1:
+    return GncNumeric(int(fraction * denom), denom)
+  return GncNumeric.fromFraction(fraction)
+
+def _fraction(numeric):
+  if isinstance(numeric, GncNumeric):
+    return numeric.fraction
+  return Fraction(numeric)
+
+class _Entity(object):
+  """Base of the fake engine objects. Like the real bindings,
+  Class(instance=None) makes an object whose get_instance() is None,
+  and Class(instance=x) returns x itself"""
+  def __new__(cls, *args, **kwargs):
+    instance = kwargs.get('instance')
+    if instance is not None:
+      return instance
+    return object.__new__(cls)
+
+  def _isWrapper(self, kwargs):
+    if kwargs.has_key('instance'):
+      if kwargs['instance'] is None:
+        self.isNull = True
+      return True
+    self.isNull = False
+    return False
+
+  def get_instance(self):
+    if self.isNull:
+      return None
+    return self
+
+class GUID(object):
+  def __init__(self, number):
+    self.number = number
+
+  def get_instance(self):
+    return self
+
+def guid_to_string(guid):
+  return '%032x' % guid.number
+
+class GncNumeric(object):
+  def __init__(self, num = 0, denom = 1):
+    self.fraction = Fraction(num, denom)
+    self._num = num
+    self._denom = denom
+
+  @staticmethod
+  def fromFraction(fraction, denom = None):
+    if denom is None:
+      return GncNumeric(fraction.numerator, fraction.denominator)
+    fraction = _round(fraction, denom)
+    return GncNumeric(fraction.numerator * (denom // fraction.denominator), denom)
+
+  def num(self):
+    return self._num
+
+  def denom(self):
+    return self._denom
+
+  def negative_p(self):
+    return self._num < 0
+
+  def zero_p(self):
+    return self._num == 0
+
+  def neg(self):
+    return GncNumeric(-self._num, self._denom)
+
+  def to_decimal(self, max_decimal_places):
+    """Convert in place to a power of ten denominator, False if the
+    value has no exact decimal representation"""
+    places = 0
+    denom = self.fraction.denominator
+    while denom != 1 and places < 64:
+      if denom % 10 == 0: denom //= 10
+      elif denom % 2 == 0: denom //= 2
+      elif denom % 5 == 0: denom //= 5
+      else: return False
+      places += 1
+    if denom != 1:
+      return False
+    self._num = self.fraction.numerator * 10 ** places // self.fraction.denominator
+    self._denom = 10 ** places
+    return True
+
+  def to_string(self):
+    return "%d/%d" % (self._num, self._denom)
+
+  def get_instance(self):
+    return self
+
+  def __repr__(self):
+    return "GncNumeric(%s)" % self.to_string()
+
+class GncCommodity(_Entity):
+  def __init__(self, book = None, fullname = '', namespace = '', mnemonic = '',
+               cusip = '', fraction = 1, **kwargs):
+    if self._isWrapper(kwargs):
+      return
+    self.book = book
+    self.fullname = fullname
+    self.namespace = namespace
+    self.mnemonic = mnemonic
+    self.cusip = cusip
+    self.fraction = fraction
+    self.quoteFlag = False
+    self.quoteSource = None
+
+  def get_mnemonic(self): return self.mnemonic
+  def set_mnemonic(self, mnemonic): self.mnemonic = mnemonic
+  def get_fullname(self): return self.fullname
+  def get_namespace(self): return self.namespace
+  def get_cusip(self): return self.cusip
+  def get_fraction(self): return self.fraction
+  def get_unique_name(self): return self.namespace + '::' + self.mnemonic
+  def set_quote_flag(self, flag): self.quoteFlag = flag
+  def set_quote_source(self, source): self.quoteSource = source
+
+class CommodityNamespace(object):
+  def __init__(self, name):
+    self.name = name
+    self.commodities = []
+
+  def get_commodity_list(self):
+    return list(self.commodities)
+
+class CommodityTable(object):
+  def __init__(self):
+    self.namespaces = {}
+
+  def add_namespace(self, name, book):
+    if not self.namespaces.has_key(name):
+      self.namespaces[name] = CommodityNamespace(name)
+    return self.namespaces[name]
+
+  def lookup(self, namespace, mnemonic):
+    ns = self.namespaces.get(namespace)
+    if ns is not None:
+      for c in ns.commodities:
+        if c.mnemonic == mnemonic:
+          return c
+    return GncCommodity(instance = None)
+
+  def lookup_unique(self, uniqueName):
+    namespace, mnemonic = uniqueName.split('::', 1)
+    return self.lookup(namespace, mnemonic)
+
+  def insert(self, commodity):
+    existing = self.lookup(commodity.namespace, commodity.mnemonic)
+    if existing.get_instance() is not None:
+      return existing
+    self.add_namespace(commodity.namespace, None).commodities.append(commodity)
+    return commodity
+
+  def remove(self, commodity):
+    ns = self.namespaces.get(commodity.namespace)
+    if ns is not None and commodity in ns.commodities:
+      ns.commodities.remove(commodity)
+
+def gnc_commodity_equal(a, b):
+  if a is None or b is None:
+    return a is b
+  return a is b or a.get_unique_name() == b.get_unique_name()
+
+def gnc_quote_source_lookup_by_internal(name):
+  return name
+
+class GncPrice(_Entity):
+  def __init__(self, book = None, **kwargs):
+    if self._isWrapper(kwargs):
+      return
+    self.book = book
+    self.time = None
+    self.commodity = None
+    self.currency = None
+    self.value = GncNumeric(0)
+    self.typestr = None
+    self.source = None
+
+  def get_time(self): return self.time
+  def set_time(self, time): self.time = time
+  def get_commodity(self): return self.commodity
+  def set_commodity(self, commodity): self.commodity = commodity
+  def get_currency(self): return self.currency
+  def set_currency(self, currency): self.currency = currency
+  def get_value(self): return self.value
+  def set_value(self, value): self.value = value
+  def get_typestr(self): return self.typestr
+  def set_typestr(self, typestr): self.typestr = typestr
+  def get_source(self): return self.source
+  def set_source(self, source): self.source = source
+
+def gnc_price_create(book):
+  return GncPrice(book)
+
+class PriceDB(object):
+  def __init__(self):
+    self.prices = []
+
+  def add_price(self, price):
+    if price not in self.prices:
+      self.prices.append(price)
+
+  def get_prices(self, commodity, currency):
+    return [p for p in self.prices
+            if gnc_commodity_equal(p.commodity, commodity)
+            and (currency is None or gnc_commodity_equal(p.currency, currency))]
+
+class Account(_Entity):
+  def __init__(self, book = None, **kwargs):
+    if self._isWrapper(kwargs):
+      return
+    self.book = book
+    self.name = ''
+    self.code = ''
+    self.description = ''
+    self.type = ACCT_TYPE_NONE
+    self.commodity = None
+    self.placeholder = False
+    self.parent = None
+    self.children = []
+    self.splits = []
+    self.splitsSorted = True
+    self.lots = []
+
+  def GetName(self): return self.name
+  def SetName(self, name): self.name = name
+  def GetCode(self): return self.code
+  def SetCode(self, code): self.code = code
+  def GetDescription(self): return self.description
+  def SetDescription(self, description): self.description = description
+  def GetType(self): return self.type
+  def SetType(self, type): self.type = type
+  def GetCommodity(self): return self.commodity
+  def SetCommodity(self, commodity): self.commodity = commodity
+  def GetPlaceholder(self): return self.placeholder
+  def SetPlaceholder(self, placeholder): self.placeholder = placeholder
+
+  def get_parent(self):
+    if self.parent is None:
+      return Account(instance = None)
+    return self.parent
+
+  def get_children(self):
+    return list(self.children)
+
+  def append_child(self, child):
+    if child.parent is not None:
+      child.parent.children.remove(child)
+    child.parent = self
+    self.children.append(child)
+
+  def _lookup(self, matches):
+    """Breadth first like gnc_account_lookup_by_name: direct children,
+    then their sub-trees"""
+    for child in self.children:
+      if matches(child):
+        return child
+    for child in self.children:
+      found = child._lookup(matches)
+      if found.get_instance() is not None:
+        return found
+    return Account(instance = None)
+
+  def lookup_by_name(self, name):
+    return self._lookup(lambda acc: acc.name == name)
+
+  def lookup_by_code(self, code):
+    return self._lookup(lambda acc: acc.code == code)
+
+  def GetSplitList(self):
+    if not self.splitsSorted:
+      self.splits.sort(key = lambda s: (s.transaction.datePosted,
+                                        s.transaction.sequence))
+      self.splitsSorted = True
+    return list(self.splits)
+
+  def GetLotList(self):
+    return list(self.lots)
+
+  def GetBalance(self):
+    return _numericAt(sum([s.amount for s in self.splits], Fraction(0)),
+                      self.commodity.get_fraction())
+
+class GncLot(_Entity):
+  def __init__(self, book = None, **kwargs):
+    if self._isWrapper(kwargs):
+      return
+    self.book = book
+    self.account = None
+    self.splits = []
+
+  def get_account(self): return self.account
+  def get_split_list(self): return list(self.splits)
+
+  def get_balance(self):
+    return GncNumeric.fromFraction(sum([s.amount for s in self.splits], Fraction(0)))
+
+  def is_closed(self):
+    return len(self.splits) > 0 and self.get_balance().zero_p()
+
+  def get_earliest_split(self):
+    return min(self.splits, key = lambda s: (s.transaction.datePosted,
+                                             s.transaction.sequence))
+
+class Split(_Entity):
+  def __init__(self, book = None, **kwargs):
+    if self._isWrapper(kwargs):
+      return
+    self.book = book
+    self.transaction = None
+    self.account = None
+    self.value = Fraction(0)
+    self.amount = Fraction(0)
+    self.lot = None
+    self.memo = ''
+
+  def GetParent(self):
+    return self.transaction
+
+  def SetParent(self, transaction):
+    if self.transaction is not None:
+      self.transaction.splits.remove(self)
+    self.transaction = transaction
+    transaction.splits.append(self)
+    if self.account is not None:
+      self.account.splitsSorted = False
+
+  parent = property(GetParent, SetParent)
+
+  def GetAccount(self):
+    return self.account
+
+  def SetAccount(self, account):
+    if self.account is not None:
+      self.account.splits.remove(self)
+    self.account = account
+    account.splits.append(self)
+    account.splitsSorted = False
+
+  def GetValue(self):
+    return _numericAt(self.value, 100)
+
+  def SetValue(self, value):
+    self.value = _fraction(value)
+
+  def GetAmount(self):
+    if self.account is None:
+      return _numericAt(self.amount, 100)
+    return _numericAt(self.amount, self.account.commodity.get_fraction())
+
+  def SetAmount(self, amount):
+    self.amount = _fraction(amount)
+
+  def SetSharePriceAndAmount(self, price, amount):
+    self.amount = _fraction(amount)
+    self.value = _round(_fraction(price) * self.amount, 100)
+
+  def GetSharePrice(self):
+    if self.amount == 0:
+      if self.value == 0:
+        return GncNumeric(1, 1)
+      return GncNumeric(0, 1)
+    price = self.value / self.amount
+    if price == 0:
+      return GncNumeric(0, 1)
+    digits = len(str(abs(price.numerator) // price.denominator).lstrip('0'))
+    places = max(0, PRICE_SIGFIGS - digits)
+    return GncNumeric.fromFraction(price, 10 ** places)
+
+  def GetOtherSplit(self):
+    splits = self.transaction.splits
+    if len(splits) == 2:
+      return splits[splits[0] is self and 1 or 0]
+    return Split(instance = None)
+
+  def GetLot(self):
+    return self.lot
+
+  def GetMemo(self): return self.memo
+  def SetMemo(self, memo): self.memo = memo
+
+# order of creation, GnuCash sorts splits of same date by it too
+_sequence = count(1)
+
+class Transaction(_Entity):
+  def __init__(self, book = None, **kwargs):
+    if self._isWrapper(kwargs):
+      return
+    self.book = book
+    self.currency = None
+    self.description = ''
+    self.notes = None
+    self.datePosted = 0
+    self.splits = []
+    self.editLevel = 0
+    self.sequence = _sequence.next()
+
+  def BeginEdit(self):
+    self.editLevel += 1
+
+  def CommitEdit(self):
+    self.editLevel -= 1
+    if self.editLevel == 0:
+      self._scrub()
+
+  def GetCurrency(self): return self.currency
+  def SetCurrency(self, currency): self.currency = currency
+  def GetDescription(self): return self.description
+  def SetDescription(self, description): self.description = description
+  def GetNotes(self): return self.notes
+  def SetNotes(self, notes): self.notes = notes
+  def GetDate(self): return self.datePosted
+  def GetGUID(self): return GUID(self.sequence)
+
+  def SetDatePostedSecs(self, secs):
+    self.datePosted = secs
+    for s in self.splits:
+      if s.account is not None:
+        s.account.splitsSorted = False
+  def GetSplitList(self): return list(self.splits)
+
+  def _scrub(self):
+    """What GnuCash does on commit: cash splits have amount equal to
+    value, and the transaction is balanced through Imbalance-CUR"""
+    for s in self.splits:
+      if s.account is not None and gnc_commodity_equal(s.account.commodity,
+                                                       self.currency):
+        s.amount = s.value
+    imbalance = sum([s.value for s in self.splits], Fraction(0))
+    if imbalance != 0 and self.currency is not None:
+      account = self.book._specialAccount('Imbalance-', self.currency)
+      s = Split(self.book)
+      s.SetParent(self)
+      s.SetAccount(account)
+      s.value = s.amount = -imbalance
+
+  def ScrubGains(self, gainsAccount):
+    """Assign stock splits to lots FIFO, and book realized gains"""
+    for s in list(self.splits):
+      if s.lot is None and s.amount != 0 and s.account is not None \
+         and not gnc_commodity_equal(s.account.commodity, self.currency):
+        self.book._assignToLots(s)
+
+class Book(object):
+  def __init__(self):
+    self.table = CommodityTable()
+    self.priceDB = PriceDB()
+    for mnemonic in currencies:
+      self.table.insert(GncCommodity(self, mnemonic, 'CURRENCY', mnemonic, '', 100))
+    self.root = Account(self)
+    self.root.SetName('Root Account')
+    self.root.SetType(ACCT_TYPE_ROOT)
+
+  def get_root_account(self): return self.root
+  def get_table(self): return self.table
+  def get_price_db(self): return self.priceDB
+  def get_instance(self): return self
+
+  def _specialAccount(self, prefix, currency):
+    name = prefix + currency.get_mnemonic()
+    for child in self.root.children:
+      if child.name == name:
+        return child
+    account = Account(self)
+    account.SetName(name)
+    account.SetType(prefix == 'Imbalance-' and ACCT_TYPE_BANK or ACCT_TYPE_INCOME)
+    account.SetCommodity(currency)
+    self.root.append_child(account)
+    return account
+
+  def _assignToLots(self, split):
+    account = split.account
+    while split is not None:
+      lot = None
+      for candidate in account.lots:
+        balance = sum([s.amount for s in candidate.splits], Fraction(0))
+        if balance != 0 and (balance > 0) != (split.amount > 0):
+          lot = candidate
+          break
+      if lot is None:
+        lot = GncLot(self)
+        lot.account = account
+        account.lots.append(lot)
+        lot.splits.append(split)
+        split.lot = lot
+        return
+      balance = sum([s.amount for s in lot.splits], Fraction(0))
+      remainder = None
+      if abs(split.amount) > abs(balance):
+        # split the split, the part that does not fit goes to next lot
+        remainder = Split(self)
+        remainder.SetParent(split.transaction)
+        remainder.SetAccount(account)
+        remainder.amount = split.amount + balance
+        remainder.value = _round(split.value * remainder.amount / split.amount, 100)
+        split.value -= remainder.value
+        split.amount = -balance
+      lot.splits.append(split)
+      split.lot = lot
+      self._bookGain(lot, split)
+      split = remainder
+
+  def _bookGain(self, lot, closing):
+    """Realized gain of CLOSING split against the opening splits of LOT,
+    as its own transaction like GnuCash does"""
+    opening = [s for s in lot.splits if s is not closing
+               and (s.amount > 0) != (closing.amount > 0) and s.amount != 0]
+    openAmount = sum([s.amount for s in opening], Fraction(0))
+    openValue = sum([s.value for s in opening], Fraction(0))
+    if openAmount == 0:
+      return
+    basis = openValue * (-closing.amount) / openAmount
+    gain = _round(-(closing.value + basis), 100)
+    if gain == 0:
+      return
+    currency = closing.transaction.currency
+    tran = Transaction(self)
+    tran.BeginEdit()
+    tran.SetCurrency(currency)
+    tran.SetDescription('Realized Gain/Loss')
+    tran.SetDatePostedSecs(closing.transaction.datePosted)
+    s1 = Split(self)
+    s1.SetParent(tran)
+    s1.SetAccount(lot.account)
+    s1.value = gain
+    s1.lot = lot
+    lot.splits.append(s1)
+    s2 = Split(self)
+    s2.SetParent(tran)
+    s2.SetAccount(self._specialAccount('Orphaned Gains-', currency))
+    s2.value = s2.amount = -gain
+    tran.CommitEdit()
+
+# books by url, so Session(url) in the importer sees the book a
+# benchmark has prepared
+books = {}
+
+class Session(object):
+  def __init__(self, url, ignore_lock = False, is_new = False, force_new = False):
+    self.url = url
+    if is_new or not books.has_key(url):
+      books[url] = Book()
+    self.book = books[url]
+    self.saveCount = 0
+
+  def save(self):
+    self.saveCount += 1
+
+  def end(self):
+    pass
@@ -0,0 +1,406 @@
+#!/usr/bin/python
+#
+# Generate synthetic OFX 1.02 or 2.11 investment statements (INVSTMTRS) for
+# benchmarking the importer, and credit card statements (CCSTMTRS) for
+# the mock server. The statements have the same shape as
+# the ones real brokers send: a SECLIST with stocks and options, an
+# INVTRANLIST with buys/sells, option trades, income, transfers and
+# bank transactions, and an INVPOSLIST with one entry per lot like
+# Interactive Brokers does.
+#
+# Output is deterministic for a given seed.
+
+import sys
+import random
+import argparse
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+TWO_PLACES = Decimal('0.01')
+
+# fraction of --records that goes into each kind of record
+record_mix = (('trades', 0.45), ('options', 0.15), ('income', 0.15),
+              ('transfers', 0.05), ('bank', 0.20))
+
+class StatementWriter:
+  """Write OFX SGML, either with every element closed (which is what
+  importOfx.py BeautifulSoup based parser needs), or with leaf
+  elements left unclosed as allowed by OFX 1.x. With XML the same
+  statement is written as OFX 2.x"""
+  def __init__(self, out, closeElements = True, xml = False):
+    self.out = out
+    self.closeElements = closeElements or xml
+    self.xml = xml
+
+  def header(self):
+    if self.xml:
+      self.out.write('<?xml version="1.0" encoding="US-ASCII" standalone="no"?>\r\n'
+                     '<?OFX OFXHEADER="200" VERSION="211" SECURITY="NONE"'
+                     ' OLDFILEUID="NONE" NEWFILEUID="NONE"?>\r\n')
+      return
+    self.out.write("\r\n".join(["OFXHEADER:100",
+                                "DATA:OFXSGML",
+                                "VERSION:102",
+                                "SECURITY:NONE",
+                                "ENCODING:USASCII",
+                                "CHARSET:1252",
+                                "COMPRESSION:NONE",
+                                "OLDFILEUID:NONE",
+                                "NEWFILEUID:NONE",
+                                "", ""]))
+
+  def start(self, tag):
+    self.out.write("<%s>\r\n" % tag)
+
+  def end(self, tag):
+    self.out.write("</%s>\r\n" % tag)
+
+  def field(self, tag, value):
+    if self.closeElements:
+      self.out.write("<%s>%s</%s>\r\n" % (tag, value, tag))
+    else:
+      self.out.write("<%s>%s\r\n" % (tag, value))
+
+def ofxDate(dt):
+  return dt.strftime("%Y%m%d%H%M%S")
+
+def money(value):
+  return str(Decimal(str(value)).quantize(TWO_PLACES))
+
+class Security:
+  def __init__(self, cusip, ticker, name, price, option = None):
+    self.cusip = cusip
+    self.ticker = ticker
+    self.name = name
+    self.price = price
+    # (underlying Security, 'PUT' or 'CALL', strike, expiration)
+    self.option = option
+
+def makeSecurities(rnd, count, asOf):
+  """Make COUNT stocks, and an option series on each of them"""
+  stocks = []
+  options = []
+  for i in range(count):
+    ticker = "S%04d" % i
+    price = Decimal(rnd.randint(500, 50000)) / 100
+    stock = Security("9%08d" % i, ticker, "Synthetic Corp %d" % i, price)
+    stocks.append(stock)
+    optType = rnd.choice(('PUT', 'CALL'))
+    strike = price.quantize(Decimal('1'))
+    expire = asOf + timedelta(days = rnd.randint(10, 300))
+    optTicker = "%s %s%s" % (ticker, expire.strftime("%y%m%d"), optType[0])
+    options.append(Security("8%08d" % i, optTicker,
+                            "%s (%s %s %s %s)" % (optTicker, ticker,
+                                                  expire.strftime("%b %d %Y"),
+                                                  strike, optType.title()),
+                            (price / 20).quantize(TWO_PLACES),
+                            (stock, optType, strike, expire)))
+  return stocks, options
+
+def writeInvTran(w, fitid, date, memo):
+  w.start("INVTRAN")
+  w.field("FITID", fitid)
+  w.field("DTTRADE", ofxDate(date))
+  w.field("DTSETTLE", ofxDate(date + timedelta(days = 3)))
+  w.field("MEMO", memo)
+  w.end("INVTRAN")
+
+def writeSecId(w, sec):
+  w.start("SECID")
+  w.field("UNIQUEID", sec.cusip)
+  w.field("UNIQUEIDTYPE", "CUSIP")
+  w.end("SECID")
+
+def writeTrade(w, rnd, fitid, date, sec, isOption):
+  buy = rnd.random() < 0.5
+  units = isOption and rnd.randint(1, 10) or rnd.randint(1, 50) * 10
+  price = sec.price
+  commission = Decimal('9.99')
+  gross = units * (isOption and 100 or 1) * price
+  if buy:
+    aggregate, wrapper = "INVBUY", (isOption and "BUYOPT" or "BUYSTOCK")
+    total = -gross - commission
+  else:
+    aggregate, wrapper = "INVSELL", (isOption and "SELLOPT" or "SELLSTOCK")
+    units = -units
+    total = gross - commission
+  w.start(wrapper)
+  w.start(aggregate)
+  writeInvTran(w, fitid, date, "%s %s" % (buy and "BOUGHT" or "SOLD", sec.ticker))
+  writeSecId(w, sec)
+  w.field("UNITS", units)
+  w.field("UNITPRICE", price)
+  w.field("COMMISSION", commission)
+  w.field("TOTAL", money(total))
+  w.field("SUBACCTSEC", "CASH")
+  w.field("SUBACCTFUND", "CASH")
+  w.end(aggregate)
+  if isOption:
+    if buy: w.field("OPTBUYTYPE", rnd.choice(("BUYTOOPEN", "BUYTOCLOSE")))
+    else: w.field("OPTSELLTYPE", rnd.choice(("SELLTOOPEN", "SELLTOCLOSE")))
+    w.field("SHPERCTRCT", 100)
+  else:
+    if buy: w.field("BUYTYPE", "BUY")
+    else: w.field("SELLTYPE", "SELL")
+  w.end(wrapper)
+
+def writeIncome(w, rnd, fitid, date, sec):
+  incomeType = rnd.choice(("DIV", "DIV", "INTEREST", "CGLONG", "CGSHORT"))
+  w.start("INCOME")
+  writeInvTran(w, fitid, date, "%s %s" % (incomeType, sec.ticker))
+  writeSecId(w, sec)
+  w.field("INCOMETYPE", incomeType)
+  w.field("TOTAL", money(Decimal(rnd.randint(100, 100000)) / 100))
+  w.field("SUBACCTSEC", "CASH")
+  w.field("SUBACCTFUND", "CASH")
+  w.end("INCOME")
+
+def writeTransfer(w, rnd, fitid, date, sec):
+  w.start("TRANSFER")
+  writeInvTran(w, fitid, date, "TRANSFER OF SECURITY %s" % sec.ticker)
+  writeSecId(w, sec)
+  w.field("SUBACCTSEC", "CASH")
+  w.field("UNITS", rnd.randint(1, 20) * 10)
+  w.field("UNITPRICE", sec.price)
+  w.field("TFERACTION", "IN")
+  w.field("POSTYPE", "LONG")
+  w.end("TRANSFER")
+
+def writeBank(w, rnd, fitid, date, currency = None):
+  w.start("INVBANKTRAN")
+  writeStmtTrn(w, rnd, fitid, date, currency)
+  w.field("SUBACCTFUND", "CASH")
+  w.end("INVBANKTRAN")
+
+def writeStmtTrn(w, rnd, fitid, date, currency = None):
+  credit = rnd.random() < 0.5
+  amount = Decimal(rnd.randint(100, 1000000)) / 100
+  w.start("STMTTRN")
+  w.field("TRNTYPE", credit and "CREDIT" or "DEBIT")
+  w.field("DTPOSTED", ofxDate(date))
+  w.field("TRNAMT", money(credit and amount or -amount))
+  w.field("FITID", fitid)
+  w.field("NAME", credit and "CLIENT REQUESTED DEPOSIT" or "CLIENT REQUESTED WITHDRAWAL")
+  w.field("MEMO", credit and "DEPOSIT %s" % fitid or "WITHDRAWAL %s" % fitid)
+  if currency is not None:
+    # an aggregate here, while CURRENCY of INVBUY and others is a leaf
+    w.start("CURRENCY")
+    w.field("CURRATE", "1.0")
+    w.field("CURSYM", currency)
+    w.end("CURRENCY")
+  w.end("STMTTRN")
+
+def writePosition(w, rnd, sec, units, asOf):
+  isOption = sec.option is not None
+  wrapper = isOption and "POSOPT" or "POSSTOCK"
+  w.start(wrapper)
+  w.start("INVPOS")
+  writeSecId(w, sec)
+  w.field("HELDINACCT", "CASH")
+  w.field("POSTYPE", "LONG")
+  w.field("UNITS", units)
+  w.field("UNITPRICE", sec.price)
+  w.field("MKTVAL", money(units * sec.price * (isOption and 100 or 1)))
+  w.field("DTPRICEASOF", ofxDate(asOf))
+  w.end("INVPOS")
+  w.end(wrapper)
+
+def writeSecInfo(w, sec, asOf):
+  w.start("SECINFO")
+  writeSecId(w, sec)
+  w.field("SECNAME", sec.name)
+  w.field("TICKER", sec.ticker)
+  w.field("UNITPRICE", sec.price)
+  w.field("DTASOF", ofxDate(asOf))
+  w.end("SECINFO")
+
+def writeSecList(w, stocks, options, asOf):
+  w.start("SECLISTMSGSRSV1")
+  w.start("SECLIST")
+  for sec in stocks:
+    w.start("STOCKINFO")
+    writeSecInfo(w, sec, asOf)
+    w.field("STOCKTYPE", "COMMON")
+    w.end("STOCKINFO")
+  for sec in options:
+    underlying, optType, strike, expire = sec.option
+    w.start("OPTINFO")
+    writeSecInfo(w, sec, asOf)
+    w.field("OPTTYPE", optType)
+    w.field("STRIKEPRICE", strike)
+    w.field("DTEXPIRE", ofxDate(expire))
+    w.field("SHPERCTRCT", 100)
+    writeSecId(w, underlying)
+    w.end("OPTINFO")
+  w.end("SECLIST")
+  w.end("SECLISTMSGSRSV1")
+
+def recordCounts(records):
+  """Split RECORDS total records according to record_mix"""
+  counts = dict((kind, int(records * share)) for kind, share in record_mix)
+  counts['trades'] += records - sum(counts.values())
+  return counts
+
+def writeSignon(w, org, asOf):
+  w.start("SIGNONMSGSRSV1")
+  w.start("SONRS")
+  w.start("STATUS")
+  w.field("CODE", 0)
+  w.field("SEVERITY", "INFO")
+  w.end("STATUS")
+  w.field("DTSERVER", ofxDate(asOf))
+  w.field("LANGUAGE", "ENG")
+  w.start("FI")
+  w.field("ORG", org)
+  w.end("FI")
+  w.end("SONRS")
+  w.end("SIGNONMSGSRSV1")
+
+def writeTrnStatus(w):
+  w.field("TRNUID", 1)
+  w.start("STATUS")
+  w.field("CODE", 0)
+  w.field("SEVERITY", "INFO")
+  w.end("STATUS")
+
+def fitids(prefix):
+  """FITID generator, PREFIX keeps them unique between statements"""
+  count = [0]
+  def nextFitid():
+    count[0] += 1
+    return "%s%010d" % (prefix, count[0])
+  return nextFitid
+
+def generateStatement(out, securities = 20, trades = 100, options = 20,
+                      income = 20, transfers = 5, bank = 20, lots = 1,
+                      days = 365, seed = 0, closeElements = True,
+                      xml = False, org = 'synthetic.com',
+                      acctId = '12345678', asOf = None, fitidPrefix = '',
+                      currency = None):
+  """Write a synthetic INVSTMTRS statement to OUT. LOTS is the number
+  of INVPOSLIST entries per security, like IB sends one per tax lot.
+  With CURRENCY bank transactions have a CURRENCY aggregate"""
+  rnd = random.Random(seed)
+  if asOf is None:
+    asOf = datetime(2011, 8, 31, 16, 0, 0)
+  start = asOf - timedelta(days = days)
+  stocks, optionSecs = makeSecurities(rnd, securities, asOf)
+  w = StatementWriter(out, closeElements, xml)
+
+  def randomDate():
+    return start + timedelta(seconds = rnd.randint(0, days * 86400))
+
+  w.header()
+  w.start("OFX")
+  writeSignon(w, org, asOf)
+
+  w.start("INVSTMTMSGSRSV1")
+  w.start("INVSTMTTRNRS")
+  writeTrnStatus(w)
+  w.start("INVSTMTRS")
+  w.field("DTASOF", ofxDate(asOf))
+  w.field("CURDEF", "USD")
+  w.start("INVACCTFROM")
+  w.field("BROKERID", org)
+  w.field("ACCTID", acctId)
+  w.end("INVACCTFROM")
+
+  w.start("INVTRANLIST")
+  w.field("DTSTART", ofxDate(start))
+  w.field("DTEND", ofxDate(asOf))
+  nextFitid = fitids(fitidPrefix)
+  for i in range(trades):
+    writeTrade(w, rnd, nextFitid(), randomDate(), rnd.choice(stocks), False)
+  for i in range(options):
+    writeTrade(w, rnd, nextFitid(), randomDate(), rnd.choice(optionSecs), True)
+  for i in range(income):
+    writeIncome(w, rnd, nextFitid(), randomDate(), rnd.choice(stocks))
+  for i in range(transfers):
+    writeTransfer(w, rnd, nextFitid(), randomDate(), rnd.choice(stocks))
+  for i in range(bank):
+    writeBank(w, rnd, nextFitid(), randomDate(), currency)
+  w.end("INVTRANLIST")
+
+  w.start("INVPOSLIST")
+  for sec in stocks + optionSecs:
+    for lot in range(lots):
+      writePosition(w, rnd, sec, rnd.randint(1, 100) * (sec.option and 1 or 10), asOf)
+  w.end("INVPOSLIST")
+  w.end("INVSTMTRS")
+  w.end("INVSTMTTRNRS")
+  w.end("INVSTMTMSGSRSV1")
+
+  writeSecList(w, stocks, optionSecs, asOf)
+  w.end("OFX")
+
+def generateCreditCardStatement(out, transactions = 100, days = 30, seed = 0,
+                                closeElements = True, xml = False,
+                                org = 'synthetic.com', acctId = '4000123412341234',
+                                asOf = None, fitidPrefix = ''):
+  """Write a synthetic CCSTMTRS statement to OUT"""
+  rnd = random.Random(seed)
+  if asOf is None:
+    asOf = datetime(2011, 8, 31, 16, 0, 0)
+  start = asOf - timedelta(days = days)
+  w = StatementWriter(out, closeElements, xml)
+  w.header()
+  w.start("OFX")
+  writeSignon(w, org, asOf)
+  w.start("CREDITCARDMSGSRSV1")
+  w.start("CCSTMTTRNRS")
+  writeTrnStatus(w)
+  w.start("CCSTMTRS")
+  w.field("CURDEF", "USD")
+  w.start("CCACCTFROM")
+  w.field("ACCTID", acctId)
+  w.end("CCACCTFROM")
+  w.start("BANKTRANLIST")
+  w.field("DTSTART", ofxDate(start))
+  w.field("DTEND", ofxDate(asOf))
+  nextFitid = fitids(fitidPrefix)
+  for i in range(transactions):
+    writeStmtTrn(w, rnd, nextFitid(),
+                 start + timedelta(seconds = rnd.randint(0, days * 86400)))
+  w.end("BANKTRANLIST")
+  w.start("LEDGERBAL")
+  w.field("BALAMT", money(Decimal(rnd.randint(0, 500000)) / 100))
+  w.field("DTASOF", ofxDate(asOf))
+  w.end("LEDGERBAL")
+  w.end("CCSTMTRS")
+  w.end("CCSTMTTRNRS")
+  w.end("CREDITCARDMSGSRSV1")
+  w.end("OFX")
+
+def main():
+  parser = argparse.ArgumentParser(description="Generate a synthetic OFX 1.02 investment statement")
+  parser.add_argument('-o', dest='output', metavar='<ofx file>', help='Output file (default stdout)')
+  parser.add_argument('-r', dest='records', type=int, help='Total number of transactions, split between kinds like a typical statement (overrides the per-kind counts)')
+  parser.add_argument('--securities', type=int, default=20, help='Number of stocks, each gets an option series too')
+  parser.add_argument('--trades', type=int, default=100, help='Number of stock buys/sells')
+  parser.add_argument('--options', type=int, default=20, help='Number of option trades')
+  parser.add_argument('--income', type=int, default=20, help='Number of income records')
+  parser.add_argument('--transfers', type=int, default=5, help='Number of security transfers')
+  parser.add_argument('--bank', type=int, default=20, help='Number of bank transactions')
+  parser.add_argument('--lots', type=int, default=1, help='Positions per security (IB sends one per lot)')
+  parser.add_argument('--days', type=int, default=365, help='Number of days the statement covers')
+  parser.add_argument('--seed', type=int, default=0, help='Random seed')
+  parser.add_argument('--sgml', dest='closeElements', action='store_false', help='Leave leaf elements unclosed, OFX 1.x style')
+  parser.add_argument('--xml', action='store_true', help='Write OFX 2.x XML instead of OFX 1.02 SGML')
+  parser.add_argument('--currency', metavar='<symbol>', help='Give bank transactions a CURRENCY aggregate with this currency')
+  args = parser.parse_args()
+
+  counts = dict(trades = args.trades, options = args.options, income = args.income,
+                transfers = args.transfers, bank = args.bank)
+  if args.records is not None:
+    counts = recordCounts(args.records)
+  out = sys.stdout
+  if args.output is not None:
+    out = open(args.output, 'wb')
+  generateStatement(out, securities = args.securities, lots = args.lots,
+                    days = args.days, seed = args.seed,
+                    closeElements = args.closeElements, xml = args.xml,
+                    currency = args.currency, **counts)
+  out.close()
+
+if __name__ == "__main__":
+  main()
@@ -1,81 +1,140 @@
 #!/usr/bin/python
 
 import warnings
+import logging
 import sys, os, time, re
 import argparse
+import json
+import multiprocessing
+import Queue
+import traceback
+import hashlib
+import zlib
+import cPickle
+import codecs
+from cStringIO import StringIO
+import xml.etree.cElementTree as ElementTree
+from contextlib import contextmanager
 from BeautifulSoup import *
-from gnucash import Session, Account, Transaction, Split, GncPrice, GncNumeric, GncCommodity, GncLot
-from gnucash.gnucash_core_c import gnc_quote_source_lookup_by_internal, \
-     gnc_commodity_equal, gnc_price_create
 from datetime import datetime, timedelta
-from gnucash.gnucash_core_c import ACCT_TYPE_BANK, ACCT_TYPE_CASH, \
-     ACCT_TYPE_STOCK, ACCT_TYPE_MUTUAL, ACCT_TYPE_INCOME, ACCT_TYPE_EXPENSE, \
-     ACCT_TYPE_INVALID, ACCT_TYPE_NONE
 
-from bisect import bisect_right
+from bisect import bisect_left, bisect_right
 from decimal import Decimal
-from math import log10
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
 ZERO = Decimal(0)
 
-class flushfile(object):
-  def __init__(self, f):
-    self.f = f
-  def write(self, x):
-    self.f.write(x)
-    self.f.flush()
-  
-import sys
-# for some reason isinstance does not work
-if str(sys.stdout).find('flushfile') == -1:
-  sys.stdout = flushfile(sys.stdout)
+# GnuCash bindings the importer works against. 'gnucash' is the real
+# thing, 'fakeGnucash' is the in-memory book used by the benchmarks.
+# Can be overridden with GNUCASH_BINDINGS environment variable
+book_bindings = os.getenv('GNUCASH_BINDINGS', 'gnucash')
+
+bookBindingNames = ('Session', 'Account', 'Transaction', 'Split', 'GncPrice',
+                    'GncNumeric', 'GncCommodity', 'GncLot',
+                    'gnc_quote_source_lookup_by_internal',
+                    'gnc_commodity_equal', 'gnc_price_create',
+                    'guid_to_string',
+                    'ACCT_TYPE_BANK', 'ACCT_TYPE_CASH', 'ACCT_TYPE_STOCK',
+                    'ACCT_TYPE_MUTUAL', 'ACCT_TYPE_INCOME',
+                    'ACCT_TYPE_EXPENSE', 'ACCT_TYPE_EQUITY',
+                    'ACCT_TYPE_INVALID', 'ACCT_TYPE_NONE')
+
+def useBookBindings(moduleName):
+  """Make the GnuCash classes, functions and constants the importer
+  uses come from MODULENAME. The real bindings are split between
+  gnucash and gnucash.gnucash_core_c, fake ones are in one module"""
+  if moduleName == 'gnucash':
+    import gnucash, gnucash.gnucash_core_c
+    modules = (gnucash, gnucash.gnucash_core_c)
+  else:
+    modules = (__import__(moduleName),)
+  for name in bookBindingNames:
+    for module in modules:
+      if hasattr(module, name):
+        globals()[name] = getattr(module, name)
+        break
+    else:
+      raise ImportError("%s does not provide %s" % (moduleName, name))
+
+useBookBindings(book_bindings)
+
+log = logging.getLogger('importOfx')
+# quiet unless the caller configures logging, main() does with -q/-v
+log.addHandler(logging.NullHandler())
+
+try:
+    # the pure Python decimal of Python 2, its private constructor
+    # takes the digits as a string without validating them one by one,
+    # and _decimal_parts reads its fields the same way
+    from decimal import _dec_from_triple
+except ImportError:
+    def _dec_from_triple(sign, coefficient, exponent):
+        return Decimal('%s%se%d' % ('-' * sign, coefficient, exponent))
+
+# denominator -> (multiplier, exponent) turning NUM/DENOM into
+# NUM*MULTIPLIER/10**EXPONENT, there are few distinct denominators
+_decimal_denominators = {}
+
+def _decimal_denominator(denom):
+    try:
+        return _decimal_denominators[denom]
+    except KeyError:
+        pass
+    if denom <= 0:
+        return None
+    twos = fives = 0
+    rest = denom
+    while rest % 2 == 0:
+        rest //= 2
+        twos += 1
+    while rest % 5 == 0:
+        rest //= 5
+        fives += 1
+    if rest != 1:
+        # no exact decimal value
+        return None
+    exponent = max(twos, fives)
+    result = (2 ** (exponent - twos) * 5 ** (exponent - fives), exponent)
+    _decimal_denominators[denom] = result
+    return result
 
 def gnc_numeric_to_python_Decimal(numeric):
-    negative = numeric.negative_p()
-    if negative:
-        sign = 1
-    else:
-        sign = 0
-    copy = GncNumeric(numeric.num(), numeric.denom())
-    result = copy.to_decimal(None)
-    if not result:
+    """Exact Decimal value of NUMERIC, with integer arithmetic only. A
+    power of ten denominator gives the exponent, others with just 2 and
+    5 as factors are scaled to one"""
+    num = numeric.num()
+    scale = _decimal_denominator(numeric.denom())
+    if scale is None:
         raise Exception("gnc numeric value %s can't be converted to Decimal" %
-                        copy.to_string() )
-    digit_tuple = tuple( int(char)
-                         for char in str(copy.num())
-                         if char != '-' )
-    denominator = copy.denom()
-    exponent = int(log10(denominator))
-    assert( (10 ** exponent) == denominator )
-    return Decimal( (sign, digit_tuple, -exponent) )
+                        numeric.to_string() )
+    multiplier, exponent = scale
+    if num < 0:
+        return _dec_from_triple(1, str(-num * multiplier), -exponent)
+    return _dec_from_triple(0, str(num * multiplier), -exponent)
+
+def _decimal_parts(decimal_value):
+    """(sign, integer coefficient, exponent) of finite DECIMAL_VALUE"""
+    try:
+        return decimal_value._sign, int(decimal_value._int), decimal_value._exp
+    except AttributeError:
+        sign, digits, exponent = decimal_value.as_tuple()
+        return sign, int(''.join(map(str, digits))), exponent
 
 def gnc_numeric_from_decimal(decimal_value):
-    sign, digits, exponent = decimal_value.as_tuple()
-
-    # convert decimal digits to a fractional numerator
-    # equivlent to
-    # numerator = int(''.join(digits))
-    # but without the wated conversion to string and back,
-    # this is probably the same algorithm int() uses
-    numerator = 0
-    TEN = int(Decimal(0).radix()) # this is always 10
-    numerator_place_value = 1
-    # add each digit to the final value multiplied by the place value
-    # from least significant to most sigificant
-    for i in xrange(len(digits)-1,-1,-1):
-        numerator += digits[i] * numerator_place_value
-        numerator_place_value *= TEN
-
-    if decimal_value.is_signed():
+    sign, numerator, exponent = _decimal_parts(decimal_value)
+    if sign:
         numerator = -numerator
 
     # if the exponent is negative, we use it to set the denominator
     if exponent < 0 :
-        denominator = TEN ** (-exponent)
+        denominator = 10 ** (-exponent)
     # if the exponent isn't negative, we bump up the numerator
     # and set the denominator to 1
     else:
-        numerator *= TEN ** exponent
+        numerator *= 10 ** exponent
         denominator = 1
 
     return GncNumeric(numerator, denominator)
@@ -165,20 +224,221 @@ auto_create_commodity_accounts = True
 auto_create_income_and_expanse_accounts = True
 # True to import prices of securities from POSLIST
 auto_create_prices = True
+# True to match all transactions of a statement against the accounts'
+# history at once before importing them, needs NumPy
+bulk_duplicate_check = True
+# Name of the class parsing OFX 1.x SGML. BeautifulSoup is the generic
+# HTML parser used before OfxSoup, it needs leaf elements to be closed
+ofx_sgml_parser = 'OfxSoup'
+# Import modes, and the aggregates whose contents the parser skips in
+# each. Refreshing prices or checking positions only needs POSLIST and
+# SECLIST, the transactions of INVTRANLIST are left out of the model
+import_mode_skipped_aggregates = {'all': (),
+                                  'prices': ('invtranlist',),
+                                  'positions': ('invtranlist',)}
+# Directory where parsed OFX files are cached, keyed by hash of the
+# file contents, so re-importing the same file skips parsing. None to
+# disable the cache
+ofx_cache_dir = os.path.join(os.getenv('XDG_CACHE_HOME',
+                                       os.path.expanduser('~/.cache')),
+                             'importOfx')
+# Seconds between progress lines while importing transactions
+progress_interval = 5.0
+# Imports that save the GnuCash file keep a journal of the records
+# applied next to it, and save the file every this many records or
+# seconds, whichever comes first. When an import is interrupted,
+# importing the same statement again skips the records saved before
+journal_checkpoint_records = 1000
+journal_checkpoint_seconds = 300
+# With --pipeline OFX files are parsed in another process, at most
+# this many statements ahead of the one being imported
+pipeline_depth = 2
+
+#----------------
+# Instrumentation
+#----------------
+
+class ImportStats:
+  """Wall and CPU time spent in each import phase, plus counters of
+  the work done. Phases with the same name accumulate, phases started
+  while another one is running are reported nested under it"""
+
+  counterNames = ('splitsScanned', 'duplicatesFound', 'transactionsCreated',
+                  'scrubs')
+
+  def __init__(self):
+    self.phases = {}
+    self.phaseOrder = []
+    self.running = []
+    self.counters = dict((name, 0) for name in self.counterNames)
+
+  def count(self, name, n = 1):
+    self.counters[name] += n
+
+  def start(self, name):
+    if not self.phases.has_key(name):
+      self.phases[name] = {'depth': len(self.running), 'calls': 0,
+                           'wall': 0.0, 'cpu': 0.0}
+      self.phaseOrder.append(name)
+    self.running.append((name, time.time(), time.clock()))
+
+  def stop(self):
+    name, wall, cpu = self.running.pop()
+    phase = self.phases[name]
+    phase['calls'] += 1
+    phase['wall'] += time.time() - wall
+    phase['cpu'] += time.clock() - cpu
+
+  @contextmanager
+  def phase(self, name):
+    self.start(name)
+    try:
+      yield
+    finally:
+      self.stop()
+
+  def merge(self, other):
+    """Add phases and counters of OTHER, the asDict() of stats kept by
+    another process, nested under the phase running now. New phases
+    are listed after that phase and the ones already nested in it"""
+    depth = len(self.running)
+    at = len(self.phaseOrder)
+    if self.running:
+      at = self.phaseOrder.index(self.running[-1][0]) + 1
+      while at < len(self.phaseOrder) and \
+            self.phases[self.phaseOrder[at]]['depth'] >= depth:
+        at += 1
+    for phase in other['phases']:
+      name = phase['name']
+      if not self.phases.has_key(name):
+        self.phases[name] = {'depth': phase['depth'] + depth,
+                             'calls': 0, 'wall': 0.0, 'cpu': 0.0}
+        self.phaseOrder.insert(at, name)
+        at += 1
+      for key in ('calls', 'wall', 'cpu'):
+        self.phases[name][key] += phase[key]
+    for name, n in other['counters'].items():
+      self.count(name, n)
+
+  def asDict(self):
+    return {'phases': [dict(self.phases[name], name=name)
+                       for name in self.phaseOrder],
+            'counters': dict(self.counters)}
+
+  def printSummary(self, f = sys.stdout):
+    print >> f, "\n%-32s %8s %10s %10s" % ('Phase', 'Calls', 'Wall', 'CPU')
+    for name in self.phaseOrder:
+      phase = self.phases[name]
+      print >> f, "%-32s %8d %10.3f %10.3f" % ('  ' * phase['depth'] + name,
+                                               phase['calls'],
+                                               phase['wall'], phase['cpu'])
+    print >> f, ""
+    for name in self.counterNames:
+      print >> f, "%-32s %8d" % (name, self.counters[name])
+
+  def writeJson(self, fileName):
+    f = open(fileName, 'w')
+    json.dump(self.asDict(), f, indent = 2)
+    f.close()
+
+def timedPhase(name):
+  """Decorator that accounts the time spent in the function to phase NAME"""
+  def decorate(fn):
+    def wrapper(*args, **kwargs):
+      with stats.phase(name):
+        return fn(*args, **kwargs)
+    wrapper.__name__ = fn.__name__
+    wrapper.__doc__ = fn.__doc__
+    return wrapper
+  return decorate
+
+stats = ImportStats()
+
+class ImportProgress:
+  """Logs how many of TOTAL records were imported and how fast, every
+  INTERVAL seconds and when done"""
+
+  def __init__(self, total, interval = None):
+    if interval is None:
+      interval = progress_interval
+    self.total = total
+    self.interval = interval
+    self.done = 0
+    self.started = time.time()
+    self.nextReport = self.started + self.interval
+
+  def record(self):
+    self.done += 1
+    if time.time() >= self.nextReport:
+      self.report()
+
+  def report(self):
+    now = time.time()
+    self.nextReport = now + self.interval
+    seconds = now - self.started
+    log.info("Imported %d of %d records, %.0f records/s", self.done,
+             self.total, seconds > 0 and self.done / seconds or 0)
+
+class BufferedStreamHandler(logging.StreamHandler):
+  """StreamHandler that leaves output in the stream's buffer, instead of
+  flushing it after every message. Warnings are flushed right away,
+  everything else at most FLUSHINTERVAL seconds late"""
+
+  def __init__(self, stream = None, flushInterval = 1.0):
+    logging.StreamHandler.__init__(self, stream)
+    self.flushInterval = flushInterval
+    self.lastFlush = time.time()
+
+  def emit(self, record):
+    try:
+      self.stream.write(self.format(record) + '\n')
+    except Exception:
+      self.handleError(record)
+      return
+    if record.levelno >= logging.WARNING \
+       or time.time() - self.lastFlush >= self.flushInterval:
+      self.flush()
+
+  def flush(self):
+    logging.StreamHandler.flush(self)
+    self.lastFlush = time.time()
+
+def setupLogging(verbosity = 0):
+  """Log to stdout, warnings only with VERBOSITY below zero, each
+  transaction as it is imported with VERBOSITY above zero"""
+  handler = BufferedStreamHandler(sys.stdout)
+  handler.setFormatter(logging.Formatter('%(message)s'))
+  log.addHandler(handler)
+  if verbosity < 0: log.setLevel(logging.WARNING)
+  elif verbosity > 0: log.setLevel(logging.DEBUG)
+  else: log.setLevel(logging.INFO)
 
 #----------------
 # Data Model
 #----------------
 
 class OfxElement:
+  """Fields holding a value are kept as the element's text and
+  converted on first access, most transactions are dropped as
+  duplicates after looking at a few of their fields"""
   def __init__(self, soup):
-    for name in [c[0] for c in self.children]:
-      self.__setattr__(name, None)
+    # field name -> (type, text) of fields not converted yet
+    self._raw = {}
     #print >> sys.stderr, "%s.__init__(soup):" % (self)
     self.parse(soup)
 
+  def __getattr__(self, name):
+    raw = self.__dict__.get('_raw')
+    if raw is None or name not in raw:
+      raise AttributeError(name)
+    type, text = raw.pop(name)
+    value = convertOfxValue(type, text)
+    self.__setattr__(name, value)
+    return value
+
   def parse(self, soup):
     #print >> sys.stderr, "%s.parse" % (self)
+    children = None
     for c in self.children:
       if isinstance(c, str):
         recursive = False
@@ -199,6 +459,7 @@ class OfxElement:
           soup = tmp
         else:
           soup = BeautifulSoup()
+        children = None
         continue
       type,required,ofxName,isList = (str, True, None, False)
       name,c = c[0], c[1:]
@@ -217,7 +478,12 @@ class OfxElement:
 
       #print "name=%s type=%s ofxName=%s required=%s" % (name, type, ofxName, required)
       #print 'here1 ofxName=%s soup=%s' % (ofxName, soup)
-      elems = soup.findAll(lambda tag: ofxName is True or tag.name == ofxName, recursive=recursive)
+      if recursive:
+        elems = soup.findAll(lambda tag: tag.name == ofxName, recursive=True)
+      else:
+        if children is None:
+          children = childTagsByName(soup)
+        elems = children.get(ofxName, [])
       #print "here2 found=%s" % (elem)
       if len(elems) == 0: 
         if required:
@@ -226,10 +492,15 @@ class OfxElement:
 --------------------------------------------------------------""" % (self.__class__.__name__, ofxName, soup.prettify()))
         elif isList:
           self.__setattr__(name, [])
+        else:
+          self.__setattr__(name, None)
       elif len(elems) > 1 and not isList:
           raise RuntimeError("""--%s-- More then one %s element while parsing  -----
 %s
 --------------------------------------------------------------""" % (self.__class__.__name__, ofxName, soup.prettify()))
+      elif not isList and not isinstance(type, types.FunctionType) and \
+           not issubclass(type, OfxElement):
+        self._raw[name] = (type, elems[0].text)
       else:
         result = None
         if isList:
@@ -238,20 +509,11 @@ class OfxElement:
           #print "Here3 type=%s subclass=%s" % (type, issubclass(type, OfxElement))
           if isinstance(type, types.FunctionType):
             elem = type(elem);
-          elif isinstance(type, bool):
-            elem = type(elem.text.encode())
-            if len(elem) > 0 and elem[0] == "Y" or elem[0] == "y":
-              elem = True
-            else:
-              elem = False
           elif issubclass(type, OfxElement):
             #print "Here4 type=%s elem=%s" % (type, elem)
             elem = type(elem)
-          elif issubclass(type, datetime):
-            elem = convertOfxDateTime(elem.text.encode())
           else:
-            #print "Here5 type=%s elem=%s" % (type, elem.text.encode())
-            elem = type(elem.text.encode())
+            elem = convertOfxValue(type, elem.text)
           if isList:
             if elem is not None:
               result.append(elem)
@@ -260,11 +522,35 @@ class OfxElement:
         self.__setattr__(name,result)
 
 
+def childTagsByName(soup):
+  """Child tags of SOUP by name, all of them under True. One pass over
+  the children instead of a findAll for each field"""
+  index = {True: []}
+  for child in soup.childGenerator():
+    if isinstance(child, NavigableString):
+      continue
+    index[True].append(child)
+    index.setdefault(child.name, []).append(child)
+  return index
+
+def convertOfxValue(type, text):
+  """Value of TYPE (str, int, Decimal, datetime or bool) from the
+  TEXT of an OFX element"""
+  if isinstance(type, bool):
+    value = type(text.encode())
+    if len(value) > 0 and value[0] == "Y" or value[0] == "y":
+      return True
+    return False
+  elif issubclass(type, datetime):
+    return convertOfxDateTime(text.encode('utf-8'))
+  #print "Here5 type=%s elem=%s" % (type, text.encode())
+  return type(text.encode('utf-8'))
+
 def ofxClassToString(self):
   ret = "<" + self.__class__.__name__ + " "
   first = True
-  for name in [c[0] for c in self.children]:
-    value = self.__getattribute__(name)
+  for name in [c[0] for c in self.children if not isinstance(c, str)]:
+    value = getattr(self, name)
     if value is not None:
       value = str(value)
       if len(value) > 20: value = "..."
@@ -275,9 +561,28 @@ def ofxClassToString(self):
   return ret
 
 
+# names of OFX elements, the leaves holding a value, that the data
+# model reads; see OfxSoup. Names that are aggregates somewhere, like
+# CURRENCY of STMTTRN, are left out even if they are leaves elsewhere
+ofxElementNames = set()
+ofxAggregateNames = set()
+
 def makeOfxClass(name, *elements):
   """Dynamically define class NAME(OfxElement) and assign rest of the parameters
   to CHILDREN class variable"""
+  for c in elements:
+    if not isinstance(c, tuple):
+      continue
+    ofxName = len(c) > 3 and c[3] or c[0].lower()
+    if ofxName is True:
+      continue
+    ofxName = ofxName.lstrip('*')
+    if len(c) < 2 or isinstance(c[1], type):
+      if ofxName not in ofxAggregateNames:
+        ofxElementNames.add(ofxName)
+    else:
+      ofxAggregateNames.add(ofxName)
+      ofxElementNames.discard(ofxName)
   globals()[name] = type(name, (OfxElement,object), {'children': elements,
                                                    '__str__': lambda self: ofxClassToString(self),
                                                    '__repr__': lambda self: ofxClassToString(self)})
@@ -585,7 +890,7 @@ def parseInvestmentTransaction(soup):
   elif soup.name in ('dtstart', 'dtend', 'invbanktran'):
     return None
   else: 
-    print "Unknown investment transaction %s" % (soup.name)
+    log.warning("Unknown investment transaction %s", soup.name)
     return None
 
 makeOfxClass('SecurityInfo',
@@ -735,7 +1040,7 @@ def parseSecurityInfo(soup):
   elif soup.name == 'stockinfo':
     return StockSecurityInfo(soup)
   else: 
-    print "Unknown security info %s" % (soup.name)
+    log.warning("Unknown security info %s", soup.name)
     return None
 
 
@@ -833,8 +1138,298 @@ def parseInvestmentPosList(soup):
   elif soup.name == 'posstock':
     return StockPosition(soup)
   else: 
-    print "Unknown type of position %s" % (soup.name)
+    log.warning("Unknown type of position %s", soup.name)
+    return None
+
+#----------------
+# OFX 1.x SGML
+#----------------
+
+_xmlDeclaration = re.compile(r'<\?xml\s([^>]*)\?>')
+_ofxDeclaration = re.compile(r'<\?OFX\s([^>]*)\?>')
+_xmlAttribute = re.compile(r'([A-Za-z]+)\s*=\s*["\']([^"\']*)["\']')
+
+def parseOfxHeader(data):
+  """Return (header, body) of OFX file contents DATA. HEADER is a dict
+  of the OFX 1.x header block, like {'ENCODING': 'USASCII', 'CHARSET':
+  '1252', ...}, or of the attributes of the OFX 2.x <?OFX ...?>
+  declaration, with the ENCODING of the XML declaration. BODY is the
+  rest of the file, from the <OFX> tag"""
+  head = data[:1024].lstrip()
+  if head.startswith('<?'):
+    header = {}
+    match = _ofxDeclaration.search(head)
+    if match:
+      header.update((k.upper(), v) for k, v in _xmlAttribute.findall(match.group(1)))
+    match = _xmlDeclaration.search(head)
+    if match:
+      attributes = dict(_xmlAttribute.findall(match.group(1)))
+      header['ENCODING'] = attributes.get('encoding', 'UTF-8').upper()
+    return header, data[data.find('<OFX>'):]
+  start = data.find('<')
+  if start < 0:
+    start = len(data)
+  header = {}
+  for line in data[:start].splitlines():
+    key, sep, value = line.partition(':')
+    if sep:
+      header[key.strip().upper()] = value.strip()
+  return header, data[start:]
+
+def ofxCodec(header):
+  """Python codec of an OFX 1.x file with HEADER. USASCII files are
+  really Windows-1252 more often than not, which is what CHARSET:1252
+  says, so that is the default"""
+  if header.get('ENCODING', '').upper().replace('-', '') == 'UTF8':
+    return 'utf-8'
+  charset = header.get('CHARSET', '1252').upper()
+  if charset in ('ISO-8859-1', '8859-1'):
+    return 'latin-1'
+  if charset.isdigit():
+    charset = 'cp' + charset
+  try:
+    return codecs.lookup(charset).name
+  except LookupError:
+    return 'cp1252'
+
+class OfxSoup(BeautifulStoneSoup):
+  """BeautifulStoneSoup that knows OFX 1.x SGML. Aggregates always
+  have end tags, elements (the leaves holding a value) usually don't,
+  <UNITS>100<UNITPRICE>5.5 are two siblings. A tag holding text, or
+  one of the data model's element names that is never an aggregate,
+  is an element, and is closed when the next tag starts or its parent
+  ends. Deciding that looks at
+  the current tag only, so the tree is built in a single pass without
+  the tag stack searches of the generic nesting rules. Whitespace
+  between tags is dropped.
+
+  Aggregates in SKIPAGGREGATES keep only their elements, the
+  aggregates inside them are dropped while parsing"""
+
+  def __init__(self, markup, skipAggregates = (), **kwargs):
+    self.skipAggregates = skipAggregates
+    self.skipping = None
+    self.skipNesting = 0
+    BeautifulStoneSoup.__init__(self, markup, **kwargs)
+
+  # OFX has no tags with special handling, skip sgmllib's lookup of
+  # start_TAG and end_TAG methods and its own tag stack
+  def finish_starttag(self, tag, attrs):
+    self.unknown_starttag(tag, attrs)
+    return -1
+
+  def finish_endtag(self, tag):
+    self.unknown_endtag(tag or self.currentTag.name)
+
+  def isElement(self, tag):
+    if len(self.tagStack) < 2:
+      return False
+    return tag.name in ofxElementNames or \
+           (len(tag.contents) > 0 and isinstance(tag.contents[-1], NavigableString))
+
+  def handle_data(self, data):
+    if self.skipping is None:
+      self.currentData.append(data)
+
+  def endData(self, containerClass = NavigableString):
+    if self.currentData and not u''.join(self.currentData).strip():
+      self.currentData = []
+    BeautifulStoneSoup.endData(self, containerClass)
+
+  def unknown_starttag(self, name, attrs, selfClosing = 0):
+    if self.skipping is not None:
+      if name == self.skipping:
+        self.skipNesting += 1
+      return None
+    self.endData()
+    if self.isElement(self.currentTag):
+      self.popTag()
+    if self.currentTag.name in self.skipAggregates and \
+       name not in ofxElementNames:
+      self.skipping = name
+      self.skipNesting = 1
+      return None
+    tag = Tag(self, name, attrs, self.currentTag, self.previous)
+    if self.previous:
+      self.previous.next = tag
+    self.previous = tag
+    self.pushTag(tag)
+    return tag
+
+  def unknown_endtag(self, name):
+    if self.skipping is not None:
+      if name == self.skipping:
+        self.skipNesting -= 1
+        if self.skipNesting == 0:
+          self.skipping = None
+      return
+    self.endData()
+    if self.currentTag.name != name and self.isElement(self.currentTag):
+      self.popTag()
+    if self.currentTag.name == name:
+      self.popTag()
+    else:
+      # end tag of an aggregate with unclosed aggregates inside
+      self._popToTag(name)
+
+#----------------
+# OFX 2.x XML
+#----------------
+
+class XmlOfxNode:
+  """Just enough of BeautifulSoup Tag interface over an ElementTree
+  element for OfxElement.parse, so OFX 2.x XML statements go into the
+  same data model as the SGML ones"""
+  def __init__(self, elem):
+    self.elem = elem
+    self.name = elem.tag
+
+  def getText(self):
+    return u''.join([s.strip() for s in self.elem.itertext()])
+
+  text = property(getText)
+
+  def _candidates(self, recursive):
+    if recursive:
+      return (e for e in self.elem.iter() if e is not self.elem)
+    return iter(self.elem)
+
+  def find(self, name, recursive = True):
+    for e in self._candidates(recursive):
+      if e.tag == name:
+        return XmlOfxNode(e)
+    return None
+
+  def childGenerator(self):
+    return (XmlOfxNode(e) for e in self.elem)
+
+  def findAll(self, matches, recursive = True):
+    nodes = [XmlOfxNode(e) for e in self._candidates(recursive)]
+    return [node for node in nodes if matches(node)]
+
+  def prettify(self):
+    return ElementTree.tostring(self.elem)
+
+def isOfxXml(data):
+  """True if DATA is an OFX 2.x file, which starts with an XML
+  declaration and <?OFX OFXHEADER="200" ...?> processing instruction"""
+  head = data[:1024].lstrip()
+  return head.startswith('<?xml') or head.startswith('<?OFX')
+
+def parseOfxXml(data, skipAggregates = ()):
+  """Parse OFX 2.x DATA with the expat based iterparse. Tag names
+  are lower cased like BeautifulSoup does, and the root is returned
+  wrapped as XmlOfxNode. Aggregates inside the aggregates named in
+  SKIPAGGREGATES are removed as soon as they are parsed"""
+  stack = []
+  for event, elem in ElementTree.iterparse(StringIO(data.lstrip()),
+                                           events = ('start', 'end')):
+    if event == 'start':
+      stack.append(elem)
+    else:
+      stack.pop()
+      elem.tag = elem.tag.lower()
+      if stack and len(elem) and stack[-1].tag.lower() in skipAggregates:
+        stack[-1].remove(elem)
+  return XmlOfxNode(elem)
+
+#----------------
+# Parsed statement cache
+#----------------
+
+# Bump this when the data model classes change, so that statements
+# cached with the old classes are parsed again
+OFX_CACHE_SCHEMA = 4
+
+def ofxCacheFileName(data, mode = 'all'):
+  """Cache file for OFX file contents DATA parsed for import MODE.
+  Model classes are pickled by module name, so its part of the key
+  too"""
+  key = hashlib.sha1(data).hexdigest()
+  return os.path.join(ofx_cache_dir, '%s-%s-%s-v%d' % (key, __name__, mode,
+                                                       OFX_CACHE_SCHEMA))
+
+def loadCachedOfx(data, mode = 'all'):
+  """Return the Ofx model cached for file contents DATA or None. A
+  full model serves any import mode"""
+  if ofx_cache_dir is None:
+    return None
+  for m in (mode, 'all'):
+    try:
+      f = open(ofxCacheFileName(data, m), 'rb')
+      break
+    except IOError:
+      pass
+  else:
     return None
+  try:
+    try:
+      return cPickle.loads(zlib.decompress(f.read()))
+    except Exception, e:
+      log.warning("Ignoring unreadable cache entry for OFX file: %s", e)
+      return None
+  finally:
+    f.close()
+
+def saveCachedOfx(data, ofx, mode = 'all'):
+  if ofx_cache_dir is None:
+    return
+  fileName = ofxCacheFileName(data, mode)
+  try:
+    if not os.path.isdir(ofx_cache_dir):
+      os.makedirs(ofx_cache_dir)
+    tmpName = '%s.%d.tmp' % (fileName, os.getpid())
+    f = open(tmpName, 'wb')
+    f.write(zlib.compress(cPickle.dumps(ofx, cPickle.HIGHEST_PROTOCOL)))
+    f.close()
+    os.rename(tmpName, fileName)
+  except (IOError, OSError), e:
+    log.warning("Unable to cache parsed OFX file: %s", e)
+
+def parseOfxFile(ofxFileName, useCache = True, mode = 'all'):
+  """Return Ofx model of the file, from the cache if the same file
+  contents were parsed before. MODE is one of import_mode_skipped_aggregates,
+  other than 'all' parts of the statement are left out"""
+  with stats.phase('read file'):
+    f = open(ofxFileName, 'rb')
+    data = f.read()
+    f.close()
+  return parseOfxData(data, useCache, mode)
+
+def parseOfxData(data, useCache = True, mode = 'all'):
+  """Return Ofx model of OFX file contents DATA, like a downloaded
+  response"""
+  global soup
+  if useCache:
+    with stats.phase('cache lookup'):
+      ofx = loadCachedOfx(data, mode)
+    if ofx is not None:
+      return ofx
+  skipAggregates = import_mode_skipped_aggregates[mode]
+  if isOfxXml(data):
+    # expat decodes according to the XML declaration itself
+    header = parseOfxHeader(data)[0]
+    with stats.phase('parse xml'):
+      soup = parseOfxXml(data, skipAggregates)
+  else:
+    # decode once with the declared charset, given unicode
+    # BeautifulSoup skips UnicodeDammit's guessing of the encoding
+    with stats.phase('decode'):
+      header, body = parseOfxHeader(data)
+      body = body.decode(ofxCodec(header), 'replace')
+    with stats.phase('parse soup'):
+      if skipAggregates:
+        soup = OfxSoup(body, skipAggregates, markupMassage = False)
+      else:
+        soup = globals()[ofx_sgml_parser](body, markupMassage = False)
+  with stats.phase('build model'):
+    ofx = Ofx(soup)
+    ofx.header = header
+    ofx.digest = hashlib.sha1(data).hexdigest()
+  if useCache:
+    with stats.phase('cache store'):
+      saveCachedOfx(data, ofx, mode)
+  return ofx
 
 def findAccountByNameList(root, namelist):
   """Find an account starting from root, namelist is a list of accounts
@@ -883,7 +1478,24 @@ brokerAccount = None
 brokerSubAccounts = {}
 securityIdToCommodityMap = {}
 securityIdToAccountMap = {}
+# account path -> SplitIndex, see findIfDuplicate
+splitIndexes = {}
 ofx = None
+soup = None
+# configured names of the accounts that findBrokerAndCashAccount puts
+# under the broker account
+unprefixedAccountNames = None
+
+def resetImportState():
+  """Forget the broker account and security lookups of the previous
+  statement, so another statement can be imported in this process"""
+  global brokerAccount, brokerSubAccounts, securityIdToCommodityMap, \
+         securityIdToAccountMap
+  brokerAccount = None
+  brokerSubAccounts = {}
+  securityIdToCommodityMap = {}
+  securityIdToAccountMap = {}
+  splitIndexes.clear()
 
 #
 # Return or create sub-account NAME under the brokerAccount
@@ -953,7 +1565,7 @@ def checkCommodityForRename(uid, ticker):
     if c.get_cusip() == uid:
       # print "Found same cusip, mnemonic=%s" % (c.get_mnemonic())
       if ticker != c.get_mnemonic():
-        print "Commodity %s renamed to %s" % (c.get_mnemonic(), ticker)
+        log.info("Commodity %s renamed to %s", c.get_mnemonic(), ticker)
         c.old_mnemonic = c.get_mnemonic()
         comtab.remove(c)
         c.set_mnemonic(ticker)
@@ -1067,7 +1679,7 @@ def getAccountForSecId(secId):
                      comm.get_unique_name()))
   if commAcc.GetCode() != key:
     if commAcc.GetCode() != '':
-      print "Changing account code from %s to %s" % (commAcc.GetCode(), key)
+      log.info("Changing account code from %s to %s", commAcc.GetCode(), key)
     commAcc.SetCode(key)
   if commAcc.GetDescription() != info.securityName:
     commAcc.SetDescription(info.securityName)
@@ -1105,7 +1717,7 @@ def findOrMakeAccount(account_tuple, root_account, book,
     if len(account_path) > 0:
       if current_account.GetType() == ACCT_TYPE_NONE or \
          current_account.GetType() == ACCT_TYPE_INVALID:
-        print "Fixing account type for %s" % (getAccountPath(current_account))
+        log.info("Fixing account type for %s", getAccountPath(current_account))
         current_account.SetType(acct_type)
       return findOrMakeAccount(account_path, current_account, book,
                                     currency, acct_type)
@@ -1163,7 +1775,7 @@ def findOrCreateBrokerAccount(parent, name, acctId, currency, acctType, searchBy
 def findBrokerAndCashAccount():
   global session, brokerAccount, brokerSubAccounts, ofx, commissions_account,\
          income_account_root, income_account_tax_exempt_root, fees_account, \
-         interest_expense_account
+         interest_expense_account, unprefixedAccountNames
   orgName = ofx.signonResponse.orgName
   accFrom = ofx.stmtResponse.investmentAccountFrom
   acctId = accFrom.accountId
@@ -1179,14 +1791,17 @@ def findBrokerAndCashAccount():
 
   # TODO generalize below code into function
 
-  # prefix the account names with brokerage account path if needed
+  # prefix the account names with brokerage account path if needed,
+  # starting from the configured names for every statement imported
+  if unprefixedAccountNames is None:
+    unprefixedAccountNames = (commissions_account, fees_account,
+                              interest_expense_account, income_account_root,
+                              income_account_tax_exempt_root)
   if income_and_expanse_under_brokerage:
-    commissions_account = getAccountPath(brokerAccount) + ":" + commissions_account
-    fees_account = getAccountPath(brokerAccount) + ":" + fees_account
-    interest_expense_account = getAccountPath(brokerAccount) + ":" \
-                               + interest_expense_account
-    income_account_root = getAccountPath(brokerAccount) + ":" + income_account_root
-    income_account_tax_exempt_root = getAccountPath(brokerAccount) + ":" + income_account_tax_exempt_root
+    (commissions_account, fees_account, interest_expense_account,
+     income_account_root, income_account_tax_exempt_root) = \
+      [getAccountPath(brokerAccount) + ":" + name
+       for name in unprefixedAccountNames]
 
   if auto_create_income_and_expanse_accounts:
     commissionsAccount = findOrMakeAccount(commissions_account.split(':'),
@@ -1292,7 +1907,7 @@ def createPositionAdjustments(adjust_positions):
   
   ofxBalances = {};
 
-  print "\n\n Scanning for balance mistmatches \n\n"
+  log.info("Scanning for balance mistmatches")
 
 
   for pos in poslist:
@@ -1330,8 +1945,8 @@ def createPositionAdjustments(adjust_positions):
 
     if bal != ofxBal:
       didWarn = True
-      print '%s OFX balance=%s our balance=%s (net %s)' % (
-        getAccountPath(commAcc), ofxBal, bal, ofxBal - bal)
+      log.warning('%s OFX balance=%s our balance=%s (net %s)',
+                  getAccountPath(commAcc), ofxBal, bal, ofxBal - bal)
       if not adjust_positions:
         continue
       # adjust it
@@ -1341,13 +1956,13 @@ def createPositionAdjustments(adjust_positions):
       make_transaction(
         commAcc, otherAccount, ofxBal - bal, price, date, desc)
   if didWarn and not adjust_positions:
-    print "\n\nThere is a mistmatch between position sizes in OFX file and GnuCash."
-    print "This is normal if trades were performed only a few days ago, sometimes"
-    print "there is a delay of 3-5 days before trades settle and show up in OFX file"
-    print ""
-    print "If these positions were bought long time ago, or its the first time you are"
-    print "importing them into GnuCash, please run this script with -b option"
-    print "to create adjustments that will record the initial amount of shares you have"
+    log.warning("\nThere is a mistmatch between position sizes in OFX file and GnuCash.\n"
+                "This is normal if trades were performed only a few days ago, sometimes\n"
+                "there is a delay of 3-5 days before trades settle and show up in OFX file\n"
+                "\n"
+                "If these positions were bought long time ago, or its the first time you are\n"
+                "importing them into GnuCash, please run this script with -b option\n"
+                "to create adjustments that will record the initial amount of shares you have")
 
 def updateCommodityPrices():
   """Update the commodities price table with prices from OFX file
@@ -1436,65 +2051,75 @@ def make_transaction(commAcc, otherAccount, shares, price, date, desc, taxExempt
       s4.SetValue(s3.GetValue().neg())
 
   tran.CommitEdit()
+  stats.count('transactionsCreated')
+  addToSplitIndexes(tran)
+  journal.created(tran)
 
   if scrabGains:
-    # print "Scrubbing gains"
-    # tran = s1.GetParent()
-    if len(commAcc.GetLotList()) == 0:
+    with stats.phase('scrubGains'):
+      # print "Scrubbing gains"
+      # tran = s1.GetParent()
+      if len(commAcc.GetLotList()) == 0:
+        splits = commAcc.GetSplitList()
+        if len(splits) > 0:
+          log.debug("Found account with splits, but no lot, will scrub each transaction")
+          for s in commAcc.GetSplitList():
+            tran2 = s.GetParent()
+            tran2.BeginEdit()
+            tran2.ScrubGains(None)
+            tran2.CommitEdit()
+            stats.count('scrubs')
+
+      tran.BeginEdit()
+      tran.ScrubGains(None)
+      tran.CommitEdit()
+      stats.count('scrubs')
+      # TODO, get list of split by getting LOT of transaction we just created, then
+      # obtaining list of splits from the lot, and finding the orphaned gains there
       splits = commAcc.GetSplitList()
-      if len(splits) > 0:
-        print "Found account with splits, but no lot, will scrub each transaction"
-        for s in commAcc.GetSplitList():
-          tran2 = s.GetParent()
-          tran2.BeginEdit()
-          tran2.ScrubGains(None)
-          tran2.CommitEdit()
-
-    tran.BeginEdit()
-    tran.ScrubGains(None)
-    tran.CommitEdit()
-    # TODO, get list of split by getting LOT of transaction we just created, then
-    # obtaining list of splits from the lot, and finding the orphaned gains there
-    splits = commAcc.GetSplitList()
-    for s in splits:
-      other = s.GetOtherSplit()
-      # print "Processing split=%s other=%s" % (s, other)
-      if other.get_instance() is None:
-        continue
-      acc = other.GetAccount()
-      # print "Split %s" % (getAccountPath(acc))
+      for s in splits:
+        other = s.GetOtherSplit()
+        # print "Processing split=%s other=%s" % (s, other)
+        if other.get_instance() is None:
+          continue
+        acc = other.GetAccount()
+        # print "Split %s" % (getAccountPath(acc))
 
-      if acc.GetName().find('Orphaned Gains-') == 0:
-        lot = GncLot(instance = s.GetLot())
-        lotOpenDate = datetime.fromtimestamp(lot.get_earliest_split().GetParent().GetDate())
-        gainDate = datetime.fromtimestamp(other.GetParent().GetDate())
-        lotOpenDatePlusOneYear = lotOpenDate.replace(year = lotOpenDate.year + 1)
-        isLongTerm = gainDate > lotOpenDatePlusOneYear
+        if acc.GetName().find('Orphaned Gains-') == 0:
+          lot = GncLot(instance = s.GetLot())
+          lotOpenDate = datetime.fromtimestamp(lot.get_earliest_split().GetParent().GetDate())
+          gainDate = datetime.fromtimestamp(other.GetParent().GetDate())
+          lotOpenDatePlusOneYear = lotOpenDate.replace(year = lotOpenDate.year + 1)
+          isLongTerm = gainDate > lotOpenDatePlusOneYear
 
-        if isOptionAssignemnt: gainsAccName = "ASSIGN"
-        elif isLongTerm: gainsAccName = "CGLONG"
-        else: gainsAccName = "CGSHORT"
+          if isOptionAssignemnt: gainsAccName = "ASSIGN"
+          elif isLongTerm: gainsAccName = "CGLONG"
+          else: gainsAccName = "CGSHORT"
 
-        # print "lotOpenDate=%s gainDate=%s lotOpenDatePlusOneYear=%s isLongTerm=%s gainsAccName=%s" % (lotOpenDate, gainDate, lotOpenDatePlusOneYear, isLongTerm, gainsAccName)
+          # print "lotOpenDate=%s gainDate=%s lotOpenDatePlusOneYear=%s isLongTerm=%s gainsAccName=%s" % (lotOpenDate, gainDate, lotOpenDatePlusOneYear, isLongTerm, gainsAccName)
 
-        gainsAccount = findOrCreateCommodityAccount(getIncomeAccountName(gainsAccName,
-                                                                      taxExempt), commAcc)
+          gainsAccount = findOrCreateCommodityAccount(getIncomeAccountName(gainsAccName,
+                                                                        taxExempt), commAcc)
 
-        v1 = s.GetValue()
-        v2 = other.GetValue()
+          v1 = s.GetValue()
+          v2 = other.GetValue()
 
-        oldTran = s.GetParent()
+          oldTran = s.GetParent()
 
-        tran.BeginEdit()
-        oldTran.BeginEdit()
+          tran.BeginEdit()
+          oldTran.BeginEdit()
 
-        s.SetParent(tran)
-        other.SetParent(tran)
+          s.SetParent(tran)
+          other.SetParent(tran)
 
-        other.SetAccount(gainsAccount)
+          other.SetAccount(gainsAccount)
 
-        tran.CommitEdit()
-        oldTran.CommitEdit()
+          tran.CommitEdit()
+          oldTran.CommitEdit()
+          invalidateSplitIndex(gainsAccount)
+      # scrubbing splits the account's splits into lots and moves them
+      # between transactions
+      invalidateSplitIndex(commAcc)
 
 
 def make_transaction2(firstAcc, otherAccount, tranType, amount, date, desc,
@@ -1566,6 +2191,9 @@ def make_transaction2(firstAcc, otherAccount, tranType, amount, date, desc,
       s4.SetAccount(otherAccount)
 
   tran.CommitEdit()
+  stats.count('transactionsCreated')
+  addToSplitIndexes(tran)
+  journal.created(tran)
   return s1
 
 def extractSymbolName(commodity):
@@ -1592,28 +2220,97 @@ def getIncomeAccountName(incomeType, taxExempt):
   elif incomeType == 'FUTURE': name += income_type_accounts[5]
   elif incomeType == 'LIEU': name += income_type_accounts[6]
   else:
-    print "Warning: unknown OFX income type %s" % (incomeType)
+    log.warning("Unknown OFX income type %s", incomeType)
     name += income_type_accounts[4]
   return name
 
+class SplitIndex:
+  """Splits of an account sorted by post date, as parallel lists of
+  what findIfDuplicate compares, so a lookup bisects to the few splits
+  around a date instead of scanning the account's whole history"""
+  def __init__(self, account):
+    self.dates = []
+    self.values = []
+    self.units = []
+    self.prices = []
+    self.notes = []
+    self.descriptions = []
+    # duplicateKey()s found to be duplicates by markBulkDuplicates.
+    # Splits added later can only add duplicates, when existing ones
+    # change the index is dropped with these
+    self.knownDuplicates = set()
+    splits = [(self.splitDate(split), split) for split in account.GetSplitList()]
+    splits.sort(key = lambda item: item[0])
+    for date, split in splits:
+      self.append(len(self.dates), date, split)
+
+  def splitDate(self, split):
+    return datetime.fromtimestamp(split.parent.GetDate())
+
+  def append(self, i, date, split):
+    trans = split.parent
+    self.dates.insert(i, date)
+    self.values.insert(i, gnc_numeric_to_python_Decimal(split.GetValue()).quantize(Decimal('1.00')))
+    self.units.insert(i, gnc_numeric_to_python_Decimal(split.GetAmount()))
+    self.prices.insert(i, gnc_numeric_to_python_Decimal(split.GetSharePrice()).quantize(Decimal('1.00')))
+    self.notes.insert(i, trans.GetNotes())
+    self.descriptions.insert(i, trans.GetDescription())
+
+  def add(self, split):
+    date = self.splitDate(split)
+    self.append(bisect_right(self.dates, date), date, split)
+
+  def window(self, start, end):
+    """Range of indexes of splits posted in [START, END)"""
+    return xrange(bisect_left(self.dates, start), bisect_left(self.dates, end))
+
+def splitIndex(account):
+  key = getAccountPath(account)
+  index = splitIndexes.get(key)
+  if index is None:
+    index = splitIndexes[key] = SplitIndex(account)
+  return index
+
+def invalidateSplitIndex(account):
+  splitIndexes.pop(getAccountPath(account), None)
+
+def addToSplitIndexes(tran):
+  """Add splits of newly created transaction TRAN to the indexes of
+  their accounts"""
+  for split in tran.GetSplitList():
+    index = splitIndexes.get(getAccountPath(split.GetAccount()))
+    if index is not None:
+      index.add(split)
+
+def duplicateKey(date, amount, memo, transId):
+  """What findIfDuplicate compares, (date, amount, units, unitPrice,
+  memo, transId). If amount is a tuple, then its (shares, sharePrice)"""
+  if isinstance(amount, tuple):
+    units, unitPrice = amount
+    return (date, None, units, unitPrice.quantize(Decimal('1.00')), memo, transId)
+  return (date, amount.quantize(Decimal('1.00')), None, None, memo, transId)
+
+@timedPhase('findIfDuplicate')
 def findIfDuplicate(account, date, amount, memo, transId):
   """Find a duplicate transaction. If amount is a tuple, then its
   (shares, sharePrice) """
-  units, unitPrice = (None, None)
-  if isinstance(amount, tuple):
-    units, unitPrice = amount
-    unitPrice = unitPrice.quantize(Decimal('1.00'))
-    amount = None
-  else:
-    amount = amount.quantize(Decimal('1.00'))
+  key = duplicateKey(date, amount, memo, transId)
+  date, amount, units, unitPrice, memo, transId = key
 
-  for split in account.GetSplitList():
-    trans = split.parent
+  index = splitIndex(account)
+  if key in index.knownDuplicates:
+    stats.count('duplicatesFound')
+    return True
+
+  # only splits less than 5 days apart, as counted in whole days
+  # below, can be duplicates: [date - 5 days, date + 6 days)
+  for i in index.window(date - timedelta(days = 5), date + timedelta(days = 6)):
+    stats.count('splitsScanned')
 
-    transDate = datetime.fromtimestamp(trans.GetDate())
-    transAmount = gnc_numeric_to_python_Decimal(split.GetValue()).quantize(Decimal('1.00'))
-    transNote = trans.GetNotes()
-    transMemo = trans.GetDescription()
+    transDate = index.dates[i]
+    transAmount = index.values[i]
+    transNote = index.notes[i]
+    transMemo = index.descriptions[i]
     daysApart = abs((transDate - date).days)
     # definitely a dup, because we store transId in user-invisible note
     # note that we match this before matching Units
@@ -1634,14 +2331,15 @@ def findIfDuplicate(account, date, amount, memo, transId):
     if transId is not None and transId != "" \
        and transNote == transId \
        and daysApart < 5:
+      stats.count('duplicatesFound')
       return True
 
     if amount is not None:
       if amount != transAmount:
         continue
     else:
-      transUnits = gnc_numeric_to_python_Decimal(split.GetAmount())
-      transUnitPrice = gnc_numeric_to_python_Decimal(split.GetSharePrice()).quantize(Decimal('1.00'))
+      transUnits = index.units[i]
+      transUnitPrice = index.prices[i]
 
       # print "Here units=%s unitPrice=%s transUnits=%s transUnitPrice=%s" % (units, unitPrice,
       #                                                                      transUnits, transUnitPrice)
@@ -1663,13 +2361,158 @@ def findIfDuplicate(account, date, amount, memo, transId):
 
     # If memo is non empty and equal, and less then 3 days apart, then a dup
     if daysApart <= 5 and memo is not None and memo == transMemo:
+      stats.count('duplicatesFound')
       return True
 
     # ok memo is different, in this case only a dup if its withing 2 days
     if daysApart <= 2:
+      stats.count('duplicatesFound')
       return True
   return False
 
+def statementDuplicateQueries():
+  """(account, date, amount, memo, transId) updateTransactionList asks
+  findIfDuplicate about, for each transaction of the statement"""
+  transactions = ofx.stmtResponse.transactions
+  for tran in transactions.investmentTransactions:
+    if isinstance(tran, (MarginInterestTransaction, IncomeTransaction,
+                         ExpenseTransaction)):
+      invTran = tran.invTran
+      account = getSubAccount(tran.subAccountFund or tran.subAccountSec or 'CASH')
+      yield (account, invTran.tradeDate, tran.total, invTran.memo,
+             invTran.transactionId)
+    elif isinstance(tran, (BuyMFTransaction, SellMFTransaction,
+                           BuyOptionTransaction, SellOptionTransaction,
+                           BuyStockTransaction, SellStockTransaction,
+                           BuyDebtTransaction, SellDebtTransaction,
+                           BuyOtherTransaction, SellOtherTransaction)):
+      investment = tran.investment
+      invTran = investment.invTran
+      units = investment.units
+      if isinstance(tran, (BuyOptionTransaction, SellOptionTransaction)):
+        units *= tran.sharesPerContract
+      memo = investmentMemo(invTran.memo, buySellType(tran),
+                            getCommodityForSecId(investment.securityId))
+      yield (getAccountForSecId(investment.securityId), invTran.tradeDate,
+             (units, investment.unitPrice), memo, invTran.transactionId)
+    elif isinstance(tran, TransferTransaction):
+      invTran = tran.invTran
+      units = tran.units
+      sec = getSecListEntry(tran.securityId)
+      if isinstance(sec, OptionSecurityInfo):
+        units *= sec.sharesPerContract
+      memo = investmentMemo(invTran.memo, 'Transfer ' + tran.transferAction,
+                            getCommodityForSecId(tran.securityId), ('assign',))
+      yield (getAccountForSecId(tran.securityId), invTran.tradeDate,
+             (units, tran.unitPrice or Decimal('0.0')), memo,
+             invTran.transactionId)
+  for tran in transactions.bankTransactions:
+    transaction = tran.transaction
+    yield (getSubAccount(tran.subAccountFund), transaction.timePosted,
+           transaction.amount, transaction.memo, transaction.transactionId)
+
+def _microseconds(date):
+  return ((date.toordinal() * 86400 + date.hour * 3600 + date.minute * 60 +
+           date.second) * 1000000 + date.microsecond)
+
+def _fixedPoint(values):
+  """NumPy arrays of Decimal VALUES as integers in units of 1e-8, and
+  of which ones fit that exactly"""
+  numbers = []
+  exact = []
+  for value in values:
+    n = None
+    if value is not None:
+      sign, coefficient, exponent = _decimal_parts(value)
+      if exponent >= -8:
+        n = coefficient * 10 ** (exponent + 8)
+      else:
+        n, rest = divmod(coefficient, 10 ** (-8 - exponent))
+        if rest:
+          n = None
+      if n is not None:
+        if n >= 2 ** 63:
+          n = None
+        elif sign:
+          n = -n
+    exact.append(n is not None)
+    numbers.append(n or 0)
+  return numpy.array(numbers, dtype = numpy.int64), numpy.array(exact)
+
+def _equal(values, keyValues, s, k):
+  """Pairwise equality of Decimals VALUES[S] and KEYVALUES[K]"""
+  numbers, exact = _fixedPoint(values)
+  keyNumbers, keyExact = _fixedPoint(keyValues)
+  return exact[s] & keyExact[k] & (numbers[s] == keyNumbers[k])
+
+def _codes(values, table, none = None):
+  """NumPy array of integer codes of VALUES, equal values have equal
+  codes in TABLE. None gets code NONE if given"""
+  codes = []
+  for value in values:
+    if value is None and none is not None:
+      codes.append(none)
+    else:
+      codes.append(table.setdefault(value, len(table)))
+  return numpy.array(codes, dtype = numpy.int64)
+
+def bulkDuplicates(index, keys):
+  """duplicateKey()s in KEYS that findIfDuplicate would find to be
+  duplicates of splits in INDEX. The rules of findIfDuplicate are
+  evaluated with NumPy for all pairs of a key and a split in its date
+  window at once"""
+  if not keys or not index.dates:
+    return []
+  day = 86400 * 1000000
+  n = len(keys)
+  dates, amounts, units, prices, memos, transIds = zip(*keys)
+  splitDates = numpy.array([_microseconds(d) for d in index.dates], dtype = numpy.int64)
+  keyDates = numpy.array([_microseconds(d) for d in dates], dtype = numpy.int64)
+
+  # pairs of key and split less than 5 whole days apart, like bisecting
+  # in findIfDuplicate
+  start = numpy.searchsorted(splitDates, keyDates - 5 * day, 'left')
+  end = numpy.searchsorted(splitDates, keyDates + 6 * day, 'left')
+  counts = end - start
+  k = numpy.repeat(numpy.arange(n), counts)
+  s = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts - start, counts)
+  daysApart = numpy.abs((splitDates[s] - keyDates[k]) // day)
+
+  isUnits = numpy.array([a is None for a in amounts])[k]
+  amountMatch = numpy.where(
+    isUnits,
+    _equal(index.units, units, s, k) & _equal(index.prices, prices, s, k),
+    _equal(index.values, amounts, s, k))
+
+  strings = {}
+  notes = _codes(index.notes, strings)[s]
+  keyIds = _codes(transIds, strings)[k]
+  hasId = numpy.array([t is not None and t != "" for t in transIds])[k]
+  hasNote = numpy.array([t is not None and t != "" for t in index.notes])[s]
+  sameMemo = _codes(index.descriptions, strings)[s] == _codes(memos, strings, -1)[k]
+
+  duplicate = (hasId & (notes == keyIds) & (daysApart < 5)) | \
+              (amountMatch & ~(hasId & hasNote & (notes != keyIds)) &
+               (sameMemo | (daysApart <= 2)))
+  found = numpy.bincount(k[duplicate], minlength = n)
+  return [keys[i] for i in numpy.flatnonzero(found)]
+
+def markBulkDuplicates():
+  """Find the duplicates among all transactions of the statement in one
+  go per account, findIfDuplicate then answers for them without
+  looking at the splits"""
+  if numpy is None or not bulk_duplicate_check:
+    return
+  accounts = {}
+  for account, date, amount, memo, transId in statementDuplicateQueries():
+    path = getAccountPath(account)
+    if not accounts.has_key(path):
+      accounts[path] = (account, [])
+    accounts[path][1].append(duplicateKey(date, amount, memo, transId))
+  for account, keys in accounts.values():
+    index = splitIndex(account)
+    index.knownDuplicates.update(bulkDuplicates(index, keys))
+
 def handleRenamedCommodities():
   """Ensure that we have every commodity and account, this handles renames as well"""
   global ofx
@@ -1779,16 +2622,59 @@ def findCompatiblePosition(transfer):
   return None
 
 
+def buySellType(tran):
+  """Description of the kind of buy or sell transaction TRAN"""
+  tranType = ''
+  if isinstance(tran, BuyMFTransaction) \
+     or isinstance(tran, SellMFTransaction) \
+     or isinstance(tran, BuyOptionTransaction) \
+     or isinstance(tran, SellOptionTransaction) \
+     or isinstance(tran, BuyStockTransaction) \
+     or isinstance(tran, SellStockTransaction):
+    tranType = tran.type
+    if tranType is None or tranType == '':
+      if isinstance(tran, BuyMFTransaction): tranType = 'Buy Mutual Fund'
+      elif isinstance(tran, BuyOptionTransaction): tranType = 'Buy Option'
+      elif isinstance(tran, BuyStockTransaction):  tranType = 'Buy Stock'
+      elif isinstance(tran, SellMFTransaction): tranType = 'Sell Mutual Fund'
+      elif isinstance(tran, SellOptionTransaction): tranType = 'Sell Option'
+      elif isinstance(tran, SellStockTransaction):  tranType = 'Sell Stock'
+  return tranType
+
+def investmentMemo(memo, tranType, comm, keywords = ()):
+  """Description of an investment transaction, MEMO prefixed by
+  TRANTYPE unless it already says what happened"""
+  # if memo line is empty, make a memory line
+  if memo is None or memo == '':
+    memo = tranType
+    if memo != '': memo += ' '
+    memo += comm.get_mnemonic()
+  elif tranType != '' and memo.lower().find('buy') == -1 \
+       and memo.lower().find('sell') == -1 \
+       and memo.lower().find('cover') == -1 \
+       and memo.lower().find('short') == -1 \
+       and not [k for k in keywords if memo.lower().find(k) != -1]:
+    memo = tranType + ' ' + memo
+  return memo
+
 def updateTransactionList():
   """Copy the banking and investment transactions from OFX file """
   global session, brokerAccount, ofx
   matched = []
 
+  with stats.phase('bulk duplicates'):
+    markBulkDuplicates()
+
+  transactions = ofx.stmtResponse.transactions
+  progress = ImportProgress(len(transactions.investmentTransactions) +
+                            len(transactions.bankTransactions))
+
   #
   # Now update investment transactions
   #
 
-  for tran in ofx.stmtResponse.transactions.investmentTransactions:
+  for tran in journal.records(transactions.investmentTransactions):
+    progress.record()
     if tran in matched:
       continue
     invTran = None
@@ -1832,8 +2718,9 @@ def updateTransactionList():
         continue
 
       otherAccount = findOrCreateCommodityAccount(otherAccountName, commAcc)
-      print "NEW transaction %s otherAccountName=%s otherAccount=%s" \
-      % (tran, otherAccountName, getAccountPath(otherAccount))
+      if log.isEnabledFor(logging.INFO):
+        log.info("NEW transaction %s otherAccountName=%s otherAccount=%s",
+                 tran, otherAccountName, getAccountPath(otherAccount))
       make_transaction2(subAccount, otherAccount, 
                         'CREDIT', amount, tradeDate, memo, transId, commAcc = commAcc )
     elif isinstance(tran, BuyMFTransaction) \
@@ -1846,21 +2733,7 @@ def updateTransactionList():
     or isinstance(tran, SellDebtTransaction) \
     or isinstance(tran, BuyOtherTransaction) \
     or isinstance(tran, SellOtherTransaction):
-      tranType = ''
-      if isinstance(tran, BuyMFTransaction) \
-         or isinstance(tran, SellMFTransaction) \
-         or isinstance(tran, BuyOptionTransaction) \
-         or isinstance(tran, SellOptionTransaction) \
-         or isinstance(tran, BuyStockTransaction) \
-         or isinstance(tran, SellStockTransaction):
-        tranType = tran.type
-        if tranType is None or tranType == '':
-          if isinstance(tran, BuyMFTransaction): tranType = 'Buy Mutual Fund'
-          elif isinstance(tran, BuyOptionTransaction): tranType = 'Buy Option'
-          elif isinstance(tran, BuyStockTransaction):  tranType = 'Buy Stock'
-          elif isinstance(tran, SellMFTransaction): tranType = 'Sell Mutual Fund'
-          elif isinstance(tran, SellOptionTransaction): tranType = 'Sell Option'
-          elif isinstance(tran, SellStockTransaction):  tranType = 'Sell Stock'
+      tranType = buySellType(tran)
       investment = tran.investment
       invTran = investment.invTran
       transId = invTran.transactionId
@@ -1877,18 +2750,9 @@ def updateTransactionList():
       commAcc = getAccountForSecId(secId)
       comm = getCommodityForSecId(secId)
 
-      # if memo line is empty, make a memory line
-      if memo is None or memo == '':
-        memo = tranType
-        if memo != '': memo += ' '
-        memo += comm.get_mnemonic()
-      elif tranType != '' and memo.lower().find('buy') == -1 \
-           and memo.lower().find('sell') == -1 \
-           and memo.lower().find('cover') == -1 \
-           and memo.lower().find('short') == -1:
-        memo = tranType + ' ' + memo
+      memo = investmentMemo(memo, tranType, comm)
 
-      print "Processing buy/sell investment transaction %s" % (transId)
+      log.debug("Processing buy/sell investment transaction %s", transId)
 
       # Unfortunately there is no way to specify trade fraction
       # multiplier greater then one commodities, it would have been
@@ -1901,10 +2765,10 @@ def updateTransactionList():
 
       # Lets see if its a duplicate
       if findIfDuplicate(commAcc, tradeDate, (units, unitPrice), memo, transId):
-        print "Found suspected duplicate %s %s skipping" % (tran.__class__.__name__, tran.investment)
+        log.debug("Found suspected duplicate %s %s skipping", tran.__class__.__name__, tran.investment)
         continue
 
-      print "NEW buy/sell investment transaction %s" % (tran)
+      log.info("NEW buy/sell investment transaction %s", tran)
       make_transaction(
         commAcc, getSubAccount(subAccount),
         units, unitPrice,
@@ -1929,20 +2793,10 @@ def updateTransactionList():
       comm = getCommodityForSecId(secId)
       otherAccount = getSubAccount(subAccount)
 
-      # if memo line is empty, make a memory line
-      if memo is None or memo == '':
-        memo = tranType
-        if memo != '': memo += ' '
-        memo += comm.get_mnemonic()
-      elif tranType != '' and memo.lower().find('buy') == -1 \
-           and memo.lower().find('sell') == -1 \
-           and memo.lower().find('cover') == -1 \
-           and memo.lower().find('assign') == -1 \
-           and memo.lower().find('short') == -1:
-        memo = tranType + ' ' + memo
-
-      print "Processing transfer transaction %s secid=%s comm_unique_name=%s" \
-        % (transId, secId, comm.get_unique_name())
+      memo = investmentMemo(memo, tranType, comm, ('assign',))
+
+      log.debug("Processing transfer transaction %s secid=%s comm_unique_name=%s",
+                transId, secId, comm.get_unique_name())
 
       # Unfortunately there is no way to specify trade fraction
       # multiplier greater then one commodities, it would have been
@@ -1959,17 +2813,17 @@ def updateTransactionList():
 
       # Lets see if its a duplicate
       if findIfDuplicate(commAcc, tradeDate, (units, unitPrice), memo, transId):
-        print "Found suspected duplicate %s %s skipping" % (tran.__class__.__name__, tran)
+        log.debug("Found suspected duplicate %s %s skipping", tran.__class__.__name__, tran)
         continue
 
       # see if its a dividend reinvestment
       if memo.lower().find('dividend') >= 0 or memo.lower().find('reinvest') >= 0 \
          and tran.transferAction == 'IN' \
          and tran.type == 'LONG':
-        print "Seems to be TRANSFER for dividend reinvestment"
+        log.debug("Seems to be TRANSFER for dividend reinvestment")
         # IB does not show the price, figure it out from position
         if unitPrice == 0.0:
-          print "Price is zero, trying to find price in position list"
+          log.debug("Price is zero, trying to find price in position list")
           pos = findCompatiblePosition(tran)
           if pos == None:
             raise Exception("Unable to find position matching dividend transfer, needed to determine basis")
@@ -1998,7 +2852,7 @@ def updateTransactionList():
 
       if tran2 is not None:
         if tran.transferAction == "OUT":
-          print "Skipping OUT transaction %s for internal transfer" % (tran)
+          log.debug("Skipping OUT transaction %s for internal transfer", tran)
           continue
 
         # print "Found internal transfer match, will copy splits %s" % (tran2)
@@ -2007,7 +2861,7 @@ def updateTransactionList():
 
         # Lets see if its a duplicate
         if findIfDuplicate(acc2, tradeDate, (Decimal('0'), Decimal('0')), memo, transId):
-          print "Found suspected duplicate %s %s skipping" % (tran.__class__.__name__, tran)
+          log.debug("Found suspected duplicate %s %s skipping", tran.__class__.__name__, tran)
           continue
 
         comm1 = acc1.GetCommodity()
@@ -2045,9 +2899,12 @@ def updateTransactionList():
 
         securityIdToAccountMap[key1] = acc2
         securityIdToAccountMap[key2] = acc1
+        # split indexes are by account name
+        splitIndexes.clear()
 
         matched.append(tran2)
-        print "NEW internal transfer transaction %s" % (tran)
+        journal.matched(tran2)
+        log.info("NEW internal transfer transaction %s", tran)
         # make two empty transactions, so that next time we import
         # both IN/OUT are detected as duplicate
         make_transaction(
@@ -2063,7 +2920,7 @@ def updateTransactionList():
           scrabGains = False )
         continue
       else:
-        print "NEW transfer transaction %s doScrab=%s" % (tran, doScrab)
+        log.info("NEW transfer transaction %s doScrab=%s", tran, doScrab)
         isOptionAssignemnt = False
         # if isinstance(sec, OptionSecurityInfo) and memo.lower().find('assign'):
         #   isOptionAssignemnt = True
@@ -2075,7 +2932,9 @@ def updateTransactionList():
           isOptionAssignemnt = isOptionAssignemnt)
 
   # Now update bank transactions
-  for tran in ofx.stmtResponse.transactions.bankTransactions:
+  for tran in journal.records(transactions.bankTransactions,
+                              len(transactions.investmentTransactions)):
+    progress.record()
     if tran in matched:
       continue
     commAcc = None
@@ -2109,11 +2968,12 @@ def updateTransactionList():
                 if tran2 != tran and tran2.subAccountFund != tran.subAccountFund
                 and (tran2.transaction.amount == -amount and tran2.transaction.type != tranType)]
     if len(tran2list) == 1:
-      print "Found match %s:%s for %s:%s" % (
-        tran.subAccountFund, tran.transaction,
-        tran2list[0].subAccountFund, tran2list[0].transaction)
+      log.debug("Found match %s:%s for %s:%s",
+                tran.subAccountFund, tran.transaction,
+                tran2list[0].subAccountFund, tran2list[0].transaction)
       acc2 = getSubAccount(tran2list[0].subAccountFund)
       matched.append(tran2list[0])
+      journal.matched(tran2list[0])
 
     if acc2 is None and memo.find('PAYMENT IN LIEU OF DIVIDEND') >= 0:
       match = re.match("(?i)^([A-Z.]+).*PAYMENT IN LIEU.*", memo)
@@ -2142,32 +3002,266 @@ def updateTransactionList():
       if acc2name is not None:
         acc2 = findOrCreateCommodityAccount(acc2name, None)
 
-    print "Adding bank transaction acc1=%s acc2=%s amount=%s" % \
-      (getAccountPath(acc1), getAccountPath(acc2), amount)
+    if log.isEnabledFor(logging.INFO):
+      log.info("Adding bank transaction acc1=%s acc2=%s amount=%s",
+               getAccountPath(acc1), getAccountPath(acc2), amount)
     make_transaction2(acc1, acc2, tranType, amount, timePosted, memo, transId)
 
-
-
-def doMain(gnuCashFileName, ofxFileName, dontSave, adjust_positions):
-  global session, brokeragesRoot, brokerAccount, soup, ofx
-
-  soup = BeautifulSoup(open(ofxFileName))
-  url = "xml://"+gnuCashFileName
-  session = Session(url, True, False, False)
-  
+  progress.report()
+
+
+def recordTransactionId(tran):
+  """FITID of investment or bank transaction record TRAN"""
+  if isinstance(tran, BankTransaction):
+    return tran.transaction.transactionId
+  if isinstance(tran, (TransferTransaction, MarginInterestTransaction,
+                       IncomeTransaction, ExpenseTransaction)):
+    return tran.invTran.transactionId
+  return tran.investment.invTran.transactionId
+
+class ImportJournal:
+  """Write-ahead journal of the records of statement DIGEST imported
+  into a GnuCash file. After the loop body handled a record, its index
+  in the statement, FITID and the GUIDs of the transactions created
+  for it are appended to FILENAME. Every journal_checkpoint_records
+  records or journal_checkpoint_seconds seconds SAVE is called and a
+  CHECKPOINT line follows. Records before the last checkpoint are in
+  the saved file, so importing the same statement again skips them.
+  Without FILENAME nothing is journaled or saved"""
+
+  header = 'importOfx journal 1'
+
+  def __init__(self, fileName = None, digest = None, save = None):
+    self.fileName = fileName
+    self.digest = digest
+    self.save = save
+    # statement indexes of the records in the saved file
+    self.done = set()
+    self.indexes = {}
+    self.guids = []
+    self.matches = []
+    self.sinceCheckpoint = 0
+    self.lastCheckpoint = time.time()
+    self.f = None
+    if fileName is not None:
+      self.open()
+
+  def open(self):
+    """Read the records saved before, if the journal is of the same
+    statement, and drop what was journaled after the last checkpoint"""
+    lines = []
+    if os.path.exists(self.fileName):
+      f = open(self.fileName, 'rb')
+      lines = f.read().split('\n')
+      f.close()
+    if lines and lines[0] == '%s %s' % (self.header, self.digest):
+      keep = 1
+      records = []
+      for n, line in enumerate(lines[1:], 1):
+        if line.startswith('CHECKPOINT'):
+          self.done.update(records)
+          records = []
+          keep = n + 1
+        elif line:
+          records.append(int(line.split('\t', 1)[0]))
+      lines = lines[:keep]
+    else:
+      if lines and lines[0]:
+        log.warning("Discarding journal %s of an unfinished import of another statement",
+                    self.fileName)
+      lines = ['%s %s' % (self.header, self.digest)]
+    if self.done:
+      log.info("Resuming import, %d records were saved before", len(self.done))
+    self.f = open(self.fileName, 'wb')
+    self.f.write('\n'.join(lines) + '\n')
+    self.sync()
+
+  def sync(self):
+    self.f.flush()
+    os.fsync(self.f.fileno())
+
+  def records(self, records, first = 0):
+    """Iterate over RECORDS, the statement's records from index FIRST
+    on, leaving out the ones saved before. Each record is journaled
+    when the loop body is done with it"""
+    if self.f is None:
+      for record in records:
+        yield record
+      return
+    for i, record in enumerate(records, first):
+      self.indexes[id(record)] = i
+    for i, record in enumerate(records, first):
+      if i in self.done:
+        continue
+      self.guids = []
+      self.matches = []
+      yield record
+      self.applied(i, record)
+
+  def created(self, tran):
+    """Transaction TRAN was made for the current record"""
+    if self.f is not None:
+      self.guids.append(guid_to_string(tran.GetGUID().get_instance()))
+
+  def matched(self, record):
+    """RECORD was imported along with the current one"""
+    if self.f is not None:
+      self.matches.append(record)
+
+  def applied(self, i, record):
+    self.f.write('%d\t%s\t%s\n' % (i, recordTransactionId(record),
+                                     ' '.join(self.guids)))
+    for match in self.matches:
+      self.f.write('%d\t%s\t\n' % (self.indexes[id(match)],
+                                     recordTransactionId(match)))
+    self.sinceCheckpoint += 1
+    if self.sinceCheckpoint >= journal_checkpoint_records \
+       or time.time() - self.lastCheckpoint >= journal_checkpoint_seconds:
+      self.checkpoint()
+
+  def checkpoint(self):
+    with stats.phase('checkpoint'):
+      self.save()
+      self.f.write('CHECKPOINT\n')
+      self.sync()
+    self.sinceCheckpoint = 0
+    self.lastCheckpoint = time.time()
+
+  def close(self):
+    if self.f is not None:
+      self.f.close()
+      self.f = None
+
+  def finish(self):
+    """The import was saved, the journal is not needed anymore"""
+    if self.f is not None:
+      self.close()
+      os.remove(self.fileName)
+
+journal = ImportJournal()
+
+def openSession(gnuCashFileName):
+  """Open the GnuCash file statements are imported into"""
+  global session
+  with stats.phase('open session'):
+    session = Session("xml://"+gnuCashFileName, True, False, False)
+  return session
+
+def importStatement(statement, adjust_positions, mode = 'all'):
+  """Import parsed OFX STATEMENT into the open session, without
+  saving. MODE 'prices' only updates prices, 'positions' only compares
+  (and with ADJUST_POSITIONS adjusts) positions"""
+  global brokeragesRoot, ofx
+
+  resetImportState()
+  ofx = statement
   brokeragesRoot = findAccountByNameOrDie(brokerage_account_root)
 
-  ofx = Ofx(soup);
-
-  findBrokerAndCashAccount()
-  handleRenamedCommodities()
-  updateTransactionList()
+  with stats.phase('find accounts'):
+    findBrokerAndCashAccount()
+  with stats.phase('renamed commodities'):
+    handleRenamedCommodities()
+  if mode == 'all':
+    with stats.phase('transactions'):
+      updateTransactionList()
   # Now do final adjustments to balances as per OFX file
-  createPositionAdjustments(adjust_positions)
-  if auto_create_prices:
-    updateCommodityPrices()
-  if not dontSave: session.save()
-  else: print "Gnucash file was not saved (dry run)"
+  if mode in ('all', 'positions'):
+    with stats.phase('position adjustments'):
+      createPositionAdjustments(adjust_positions)
+  if auto_create_prices and mode in ('all', 'prices'):
+    with stats.phase('prices'):
+      updateCommodityPrices()
+
+def _parserProcess(queue, ofxFileNames, useCache, mode):
+  """Body of the pipeline's parser process, puts the statements on
+  QUEUE followed by the parsing stats"""
+  try:
+    for ofxFileName in ofxFileNames:
+      queue.put(('statement', parseOfxFile(ofxFileName, useCache, mode)))
+  except Exception:
+    queue.put(('error', traceback.format_exc()))
+  else:
+    queue.put(('stats', stats.asDict()))
+
+def _pipelineGet(queue, parser):
+  while True:
+    try:
+      return queue.get(True, 1.0)
+    except Queue.Empty:
+      if not parser.is_alive():
+        try:
+          return queue.get(True, 0.1)
+        except Queue.Empty:
+          raise Exception("OFX parser process exited with code %s" % (parser.exitcode))
+
+def _pipelineStatements(queue, parser):
+  try:
+    while True:
+      with stats.phase('wait for parser'):
+        kind, value = _pipelineGet(queue, parser)
+        if kind == 'stats':
+          # the parser's phases show up nested under the wait for them
+          stats.merge(value)
+      if kind == 'statement':
+        yield value
+      elif kind == 'stats':
+        return
+      else:
+        raise Exception("Unable to parse OFX file:\n%s" % (value))
+  finally:
+    if parser.is_alive():
+      parser.terminate()
+    parser.join()
+
+def parseOfxFiles(ofxFileNames, useCache = True, mode = 'all', pipeline = False):
+  """Iterator over the Ofx models of files OFXFILENAMES. With PIPELINE
+  a separate process parses them, while this one opens the GnuCash
+  file and imports the statements parsed before. Statements are sent
+  whole, so with a single file only parsing and opening the GnuCash
+  file overlap. GnuCash objects are only touched by this process, so
+  the writes stay single threaded"""
+  if not pipeline:
+    return (parseOfxFile(ofxFileName, useCache, mode)
+            for ofxFileName in ofxFileNames)
+  queue = multiprocessing.Queue(pipeline_depth)
+  parser = multiprocessing.Process(target = _parserProcess,
+                                   args = (queue, ofxFileNames, useCache, mode))
+  parser.daemon = True
+  # the parser would print what is buffered again
+  sys.stdout.flush()
+  parser.start()
+  return _pipelineStatements(queue, parser)
+
+def doMain(gnuCashFileName, ofxFileNames, dontSave, adjust_positions,
+           printStats = False, statsJsonFile = None, useCache = True,
+           mode = 'all', pipeline = False):
+  """Import OFX files OFXFILENAMES, or a single file name, in order
+  into the GnuCash file, saving it after each one"""
+  global journal
+  if isinstance(ofxFileNames, basestring):
+    ofxFileNames = [ofxFileNames]
+  statements = parseOfxFiles(ofxFileNames, useCache, mode, pipeline)
+  openSession(gnuCashFileName)
+  for statement in statements:
+    if not dontSave and mode == 'all':
+      journal = ImportJournal(gnuCashFileName + '.importOfx-journal',
+                              statement.digest, session.save)
+    try:
+      importStatement(statement, adjust_positions, mode)
+      if not dontSave:
+        with stats.phase('save'):
+          session.save()
+        journal.finish()
+    finally:
+      journal.close()
+      journal = ImportJournal()
+  if dontSave:
+    log.info("Gnucash file was not saved (dry run)")
+
+  if printStats:
+    stats.printSummary()
+  if statsJsonFile is not None:
+    stats.writeJson(statsJsonFile)
 
 
 dbg_gcfile='/home/max/gnucash2/am3.gnucash'
@@ -2177,14 +3271,27 @@ dbg_ofxfile='/home/max/gnucash2/ameritrade20110831.ofx'
 def main():
   parser = argparse.ArgumentParser(description="Import Ameritrade OFX file into Gnu Cash")
   parser.add_argument('gnuCashFile', metavar='<gnucash file>')
-  parser.add_argument('ofxFile', metavar='<ofx file>')
+  parser.add_argument('ofxFiles', metavar='<ofx file>', nargs='+', help='OFX files, imported in this order')
   parser.add_argument('-n', dest='dontSave', action='store_true', help='Dry run (do not save the file)')
   parser.add_argument('-b', dest='adjustBalances', action='store_true', help='Create initial balances (when trades are missing or for initial import)')
+  parser.add_argument('-t', dest='printStats', action='store_true', help='Print time spent in each import phase and work counters')
+  parser.add_argument('--stats-json', dest='statsJsonFile', metavar='<json file>', help='Write import phase timings and counters as JSON')
+  parser.add_argument('--no-cache', dest='useCache', action='store_false', help='Always parse the OFX file, do not use or update the parsed file cache')
+  parser.add_argument('--pipeline', action='store_true', help='Parse OFX files in a separate process while opening the GnuCash file and importing. Parsing overlaps importing only with several files')
+  verbosity = parser.add_mutually_exclusive_group()
+  verbosity.add_argument('-q', dest='verbosity', action='store_const', const=-1, default=0, help='Only print warnings')
+  verbosity.add_argument('-v', dest='verbosity', action='store_const', const=1, help='Also print each transaction as it is processed, and why it was skipped')
+  modes = parser.add_mutually_exclusive_group()
+  modes.add_argument('--prices-only', dest='mode', action='store_const', const='prices', default='all', help='Only update prices from POSLIST, skip transactions')
+  modes.add_argument('--positions-only', dest='mode', action='store_const', const='positions', help='Only compare (with -b adjust) positions to POSLIST, skip transactions')
   args = parser.parse_args()
-  doMain(args.gnuCashFile, args.ofxFile, args.dontSave, args.adjustBalances)
+  setupLogging(args.verbosity)
+  doMain(args.gnuCashFile, args.ofxFiles, args.dontSave, args.adjustBalances,
+         args.printStats, args.statsJsonFile, args.useCache, args.mode,
+         args.pipeline)
 
 def dbg_main(gcfile=dbg_gcfile, ofxFile=dbg_ofxfile):
   doMain(dbg_gcfile, dbg_ofxfile, True, False)
 
-if (os.getenv('INSIDE_EMACS') is None):
+if __name__ == "__main__" and os.getenv('INSIDE_EMACS') is None:
   main()
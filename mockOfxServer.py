@@ -0,0 +1,297 @@
+#!/usr/bin/python
+#
+# Local stand-in for an OFX server, to exercise ofx.py without talking
+# to a real bank. Answers ACCTINFO requests with a list of accounts,
+# and CCSTMT and INVSTMT requests with synthetic statements from
+# genOfx.py covering the requested dates, with a given number of
+# transactions per 30 days. Anything else gets a signon response.
+# Responses come after an optional delay that simulates a slow
+# server. Connections are kept alive (HTTP/1.1), and with a
+# certificate it serves HTTPS.
+#
+# Faults can be injected to exercise the client's error handling,
+# either scripted, for the next requests in order, or at random:
+#
+#   http503   answer HTTP 503
+#   drop      close the connection without an answer
+#   hang      answer only after hang seconds, past the client timeout
+#   ofxNNNN   signon response with STATUS code NNNN, severity ERROR
+#
+#   ./mockOfxServer.py -p 8080 -l 0.5 -n 1000 [-c cert.pem]
+#                      [-f http503,ofx2000] [-r 0.2 -k http503,drop]
+#
+# or startServer() from python, which runs it in a background thread.
+
+import sys
+import time
+import random
+import ssl
+import socket
+import threading
+import argparse
+import BaseHTTPServer
+import SocketServer
+import re
+from cStringIO import StringIO
+from datetime import datetime, timedelta
+
+import genOfx
+
+def ofxResponse(body):
+    return "\r\n".join(["OFXHEADER:100",
+                        "DATA:OFXSGML",
+                        "VERSION:102",
+                        "SECURITY:NONE",
+                        "ENCODING:USASCII",
+                        "CHARSET:1252",
+                        "COMPRESSION:NONE",
+                        "OLDFILEUID:NONE",
+                        "NEWFILEUID:NONE",
+                        "",
+                        "<OFX>",
+                        body,
+                        "</OFX>"])
+
+def signonResponse(code = 0, severity = "INFO"):
+    return "\r\n".join(["<SIGNONMSGSRSV1>",
+                        "<SONRS>",
+                        "<STATUS>",
+                        "<CODE>%d" % code,
+                        "<SEVERITY>%s" % severity,
+                        "</STATUS>",
+                        "<DTSERVER>%s" % time.strftime("%Y%m%d%H%M%S"),
+                        "<LANGUAGE>ENG",
+                        "</SONRS>",
+                        "</SIGNONMSGSRSV1>"])
+
+def acctInfoResponse(org, accounts, trnuid):
+    """ACCTINFO response listing ACCOUNTS, (type, acctid) pairs with
+    type CCSTMT or INVSTMT"""
+    infos = []
+    for acctType, acctId in accounts:
+        if acctType == "CCSTMT":
+            info = ["<CCACCTINFO>",
+                    "<CCACCTFROM>", "<ACCTID>%s" % acctId, "</CCACCTFROM>",
+                    "<SUPTXDL>Y", "<XFERSRC>N", "<XFERDEST>N",
+                    "<SVCSTATUS>ACTIVE",
+                    "</CCACCTINFO>"]
+        else:
+            info = ["<INVACCTINFO>",
+                    "<INVACCTFROM>", "<BROKERID>%s" % org,
+                    "<ACCTID>%s" % acctId, "</INVACCTFROM>",
+                    "<USPRODUCTTYPE>NORMAL", "<CHECKING>N",
+                    "<SVCSTATUS>ACTIVE", "<INVACCTTYPE>INDIVIDUAL",
+                    "</INVACCTINFO>"]
+        infos += ["<ACCTINFO>", "<DESC>%s %s" % (acctType, acctId)] + \
+                 info + ["</ACCTINFO>"]
+    return "\r\n".join(["<SIGNUPMSGSRSV1>",
+                        "<ACCTINFOTRNRS>",
+                        "<TRNUID>%s" % trnuid,
+                        "<STATUS>",
+                        "<CODE>0",
+                        "<SEVERITY>INFO",
+                        "</STATUS>",
+                        "<ACCTINFORS>",
+                        "<DTACCTUP>%s" % time.strftime("%Y%m%d%H%M%S")] +
+                       infos +
+                       ["</ACCTINFORS>",
+                        "</ACCTINFOTRNRS>",
+                        "</SIGNUPMSGSRSV1>"])
+
+def _requestField(request, tag):
+    match = re.search(r"<%s>\s*([^<\r\n]*)" % tag, request)
+    return match and match.group(1).strip()
+
+def _requestDate(request, tag, default):
+    value = _requestField(request, tag)
+    if not value:
+        return default
+    return datetime.strptime(value[:8], "%Y%m%d")
+
+class MockOfxHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # write each response in one go, small separate writes of headers
+    # and body on a kept alive connection hit the Nagle/delayed ACK stall
+    wbufsize = -1
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_POST(self):
+        length = int(self.headers.getheader("Content-Length") or 0)
+        request = self.rfile.read(length)
+        self.server.countRequest()
+        fault = self.server.nextFault()
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+        if fault == "drop":
+            self.close_connection = 1
+            return
+        if fault == "hang":
+            time.sleep(self.server.hang)
+        if fault == "http503":
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if fault is not None and fault.startswith("ofx"):
+            body = ofxResponse(signonResponse(int(fault[3:]), "ERROR"))
+        else:
+            body = self.server.respond(request)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ofx")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class MockOfxServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, latency = 0.0, verbose = False, certfile = None,
+                 faults = (), faultRate = 0.0, faultKinds = ("http503",),
+                 hang = 30.0, records = 100, accounts = 2, securities = 20,
+                 closeElements = True, xml = False, org = "mock.example"):
+        BaseHTTPServer.HTTPServer.__init__(self, address, MockOfxHandler)
+        self.latency = latency
+        # statement size, in transactions per 30 days of requested dates
+        self.records = records
+        # number of accounts of each type in ACCTINFO
+        self.accounts = accounts
+        self.securities = securities
+        self.closeElements = closeElements
+        self.xml = xml
+        self.org = org
+        # generated statements by request, generating the larger ones
+        # takes longer than sending them
+        self.statements = {}
+        # scripted faults for the next requests, then FAULTKINDS at
+        # random for FAULTRATE of the requests
+        self.faults = list(faults)
+        self.faultRate = faultRate
+        self.faultKinds = faultKinds
+        self.hang = hang
+        self.faultsInjected = 0
+        self.verbose = verbose
+        self.certfile = certfile
+        if certfile is not None:
+            self.socket = ssl.wrap_socket(self.socket, certfile = certfile,
+                                          server_side = True)
+        self.requests = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.connections += 1
+        SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+
+    def handle_error(self, request, client_address):
+        # clients dropping connections are normal, don't spam tracebacks
+        if self.verbose or not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+    def countRequest(self):
+        with self.lock:
+            self.requests += 1
+
+    def nextFault(self):
+        """Fault to inject into the current request, None for none"""
+        with self.lock:
+            if self.faults:
+                fault = self.faults.pop(0)
+            elif self.faultRate > 0 and random.random() < self.faultRate:
+                fault = random.choice(self.faultKinds)
+            else:
+                fault = None
+            if fault is not None:
+                self.faultsInjected += 1
+            return fault
+
+    def respond(self, request):
+        trnuid = _requestField(request, "TRNUID") or "0"
+        if "<ACCTINFORQ>" in request:
+            accounts = [(acctType, "%s%04d" % (acctType[:3], i))
+                        for acctType in ("INVSTMT", "CCSTMT")
+                        for i in range(self.accounts)]
+            return ofxResponse("\r\n".join([signonResponse(),
+                                            acctInfoResponse(self.org, accounts,
+                                                             trnuid)]))
+        for kind in ("INVSTMT", "CCSTMT"):
+            if "<%sRQ>" % kind in request:
+                statement = self.statement(kind, _requestField(request, "ACCTID"),
+                                           _requestDate(request, "DTSTART", None),
+                                           _requestDate(request, "DTEND", datetime.now()))
+                # answer with the TRNUID of the request
+                return statement.replace("<TRNUID>1", "<TRNUID>" + trnuid, 1)
+        return ofxResponse(signonResponse())
+
+    def statement(self, kind, acctId, dtstart, dtend):
+        """Synthetic statement of account ACCTID from DTSTART to DTEND"""
+        key = (kind, acctId, dtstart, dtend)
+        with self.lock:
+            if self.statements.has_key(key):
+                return self.statements[key]
+        days = max(1, dtstart is not None and (dtend - dtstart).days or 30)
+        records = max(1, self.records * days / 30)
+        # FITIDs start with the first date, so that statements of
+        # consecutive windows do not share them
+        options = dict(days = days, seed = hash(key), asOf = dtend,
+                       closeElements = self.closeElements, xml = self.xml,
+                       org = self.org, acctId = acctId or "0000",
+                       fitidPrefix = (dtend - timedelta(days = days)).strftime("%Y%m%d"))
+        out = StringIO()
+        if kind == "CCSTMT":
+            genOfx.generateCreditCardStatement(out, transactions = records, **options)
+        else:
+            genOfx.generateStatement(out, securities = self.securities,
+                                     **dict(options, **genOfx.recordCounts(records)))
+        with self.lock:
+            self.statements[key] = out.getvalue()
+        return out.getvalue()
+
+    def url(self):
+        if self.certfile is not None:
+            # certificate is made out to localhost
+            return "https://localhost:%d/" % self.server_address[1]
+        return "http://%s:%d/" % self.server_address[:2]
+
+def startServer(port = 0, **kwargs):
+    """Start a MockOfxServer on localhost in a background thread, port 0
+    picks a free port. Returns the server, server.url() is its address"""
+    server = MockOfxServer(("127.0.0.1", port), **kwargs)
+    t = threading.Thread(target = server.serve_forever)
+    t.setDaemon(True)
+    t.start()
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local mock OFX server")
+    parser.add_argument('-p', dest='port', type=int, default=8080, help='Port to listen on')
+    parser.add_argument('-l', dest='latency', type=float, default=0.0, help='Seconds to wait before answering each request')
+    parser.add_argument('-c', dest='certfile', help='PEM file with certificate and key, to serve HTTPS')
+    parser.add_argument('-n', dest='records', type=int, default=100, help='Transactions per 30 days in statements')
+    parser.add_argument('-a', dest='accounts', type=int, default=2, help='Number of investment and of credit card accounts')
+    parser.add_argument('--securities', type=int, default=20, help='Number of stocks in investment statements')
+    parser.add_argument('--sgml', dest='closeElements', action='store_false', help='Leave leaf elements of statements unclosed, OFX 1.x style')
+    parser.add_argument('--xml', action='store_true', help='Send OFX 2.x XML statements')
+    parser.add_argument('-f', dest='faults', default='', help='Comma separated faults for the first requests: http503, drop, hang or ofx<code>')
+    parser.add_argument('-r', dest='faultRate', type=float, default=0.0, help='Fraction of requests that fail at random')
+    parser.add_argument('-k', dest='faultKinds', default='http503', help='Comma separated faults to pick from at random')
+    parser.add_argument('--hang', type=float, default=30.0, help='Seconds a hang fault waits before answering')
+    args = parser.parse_args()
+    server = MockOfxServer(("127.0.0.1", args.port), latency = args.latency,
+                           verbose = True, certfile = args.certfile,
+                           faults = [f for f in args.faults.split(",") if f],
+                           faultRate = args.faultRate,
+                           faultKinds = args.faultKinds.split(","),
+                           hang = args.hang, records = args.records,
+                           accounts = args.accounts, securities = args.securities,
+                           closeElements = args.closeElements, xml = args.xml)
+    print "Serving OFX on %s" % server.url()
+    server.serve_forever()
@@ -1,34 +1,42 @@
 #!/usr/bin/python
-import time, os, httplib, urllib2
+import time, os, httplib
 import sys
+import socket
+import ssl
 import argparse
 import calendar
-from datetime import datetime
+import threading
+import Queue
+import uuid
+import random
+import tempfile
+import json
+import re
+import ConfigParser
+from urlparse import urlparse
+from cStringIO import StringIO
+from datetime import datetime, timedelta
 
 join = str.join
 
-sites = {
-       "ucard": {
-                 "caps": [ "SIGNON", "CCSTMT" ],
-                  "fid": "24909",
-                "fiorg": "Citigroup",
-                  "url": "https://secureofx2.bankhost.com/citi/cgi-forte/ofx_rt?servicename=ofx_rt&pagename=ofx",
-                },
-    "discover": {
-                 "caps": [ "SIGNON", "CCSTMT" ],
-                "fiorg": "Discover Financial Services",
-                  "fid": "7101",
-                  "url": "https://ofx.discovercard.com/",
-                },
-     "ameritrade": {
-                 "caps": [ "SIGNON", "INVSTMT" ],
-                "fiorg": "ameritrade.com",
-                  "url":
-                     #"https://ofx.ameritrade.com/ofxproxy/ofx_proxy.dll",
-                 'https://ofxs.ameritrade.com/cgi-bin/apps/OFX',
-
-                } 
-    }
+def loadSites(fileName, sites = None):
+    """Read site definitions from config file FILENAME into dict SITES,
+    see ofxsites.ini for the format. Returns SITES"""
+    if sites is None:
+        sites = {}
+    parser = ConfigParser.RawConfigParser()
+    if not parser.read(fileName):
+        raise Exception("Can not read site definitions from %s" % fileName)
+    for name in parser.sections():
+        site = dict(parser.items(name))
+        site["caps"] = site.get("caps", "").replace(",", " ").split()
+        sites[name] = site
+    return sites
+
+sites = loadSites(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               "ofxsites.ini"))
+if os.path.exists(os.path.expanduser("~/.ofxsites.ini")):
+    loadSites(os.path.expanduser("~/.ofxsites.ini"), sites)
 
 def _field(tag,value):
     return "<"+tag+">"+value
@@ -39,15 +47,184 @@ def _tag(tag,*contents):
 def _date():
     return time.strftime("%Y%m%d%H%M%S",time.localtime())
 
+# bytes read from the server at a time
+CHUNK_SIZE = 64 * 1024
+
+# defaults of the per-site "timeout", "retries" and "backoff" settings
+DEFAULT_TIMEOUT = 60
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 1.0
+# longest wait between retries, in seconds
+MAX_BACKOFF = 60.0
+
+# OFX STATUS codes worth retrying, 2000 is the general server error.
+# Others, like 15500 invalid signon, fail right away; retrying a bad
+# password only gets the user locked out
+RETRY_STATUS_CODES = (2000,)
+
+class HttpError(Exception):
+    def __init__(self, url, status, reason):
+        Exception.__init__(self, "%s returned HTTP %d %s" % (url, status, reason))
+        self.status = status
+
+class OfxError(Exception):
+    """Response with a STATUS of severity ERROR"""
+    def __init__(self, code, message):
+        Exception.__init__(self, "OFX error %d%s" % (code, message and ": " + message))
+        self.code = code
+
+_status = re.compile(r"<STATUS>\s*<CODE>\s*(\d+)\s*(?:</CODE>\s*)?"
+                     r"<SEVERITY>\s*(\w+)\s*(?:</SEVERITY>\s*)?"
+                     r"(?:<MESSAGE>\s*([^<\r\n]*))?")
+
+def checkStatus(response):
+    """Raise OfxError for the first error STATUS in RESPONSE, the
+    beginning of the response is enough, statuses come first"""
+    for match in _status.finditer(response):
+        if match.group(2) == "ERROR":
+            raise OfxError(int(match.group(1)), match.group(3) or "")
+
+def isTransient(e):
+    """Whether a failed request may succeed if tried again"""
+    if isinstance(e, OfxError):
+        return e.code in RETRY_STATUS_CODES
+    if isinstance(e, HttpError):
+        return e.status >= 500 or e.status in (408, 429)
+    # ssl.SSLError is a socket.error, but a bad certificate or a failed
+    # handshake fails the same way next time
+    if isinstance(e, ssl.SSLError):
+        return False
+    return isinstance(e, (socket.error, httplib.HTTPException))
+
+def backoffDelay(attempt, base, limit = MAX_BACKOFF):
+    """Seconds to wait before retry ATTEMPT, counted from 0: between
+    BASE/2 and BASE before the first retry, doubling with each one up
+    to LIMIT. The jitter keeps clients that failed together from
+    retrying together"""
+    return min(limit, base * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+class TokenBucket:
+    """Rate limit of RATE requests per second on average, and up to
+    BURST at once"""
+    def __init__(self, rate, burst = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until a request may be made"""
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # take the token now, callers queue up behind each other
+            self.tokens -= 1
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+# token bucket of every host with a "rate" setting
+rateLimiters = {}
+rateLimitersLock = threading.Lock()
+
+def rateLimiter(config):
+    """TokenBucket shared by all requests to the host of site CONFIG,
+    None if the site has no rate limit"""
+    if not config.get("rate"):
+        return None
+    host = urlparse(config["url"]).netloc
+    with rateLimitersLock:
+        if not rateLimiters.has_key(host):
+            rateLimiters[host] = TokenBucket(float(config["rate"]),
+                                             int(config.get("burst", 1)))
+        return rateLimiters[host]
+
+def _slot(name):
+    return "\0" + name + "\0"
+
+class _Template:
+    """Request text with named slots, split once so a query only joins
+    the fixed parts with the values of the slots"""
+    def __init__(self, text):
+        self.parts = text.split("\0")
+        self.slots = [(i, self.parts[i]) for i in range(1, len(self.parts), 2)]
+
+    def render(self, values):
+        parts = list(self.parts)
+        for i, name in self.slots:
+            parts[i] = values[name]
+        return "".join(parts)
+
 def _genuuid():
-    return os.popen("uuidgen").read().rstrip().upper()
+    return str(uuid.uuid4()).upper()
+
+class ConnectionPool:
+    """Idle keep-alive connections by (scheme, host, port). Shared by
+    all clients, so a batch of queries to one server, like the account
+    list and then every account, makes one TCP connection and TLS
+    handshake instead of one per query"""
+    def __init__(self, maxIdle = 4):
+        self.maxIdle = maxIdle
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def get(self, url, cafile = None, timeout = DEFAULT_TIMEOUT):
+        """Return (connection, reused) for parsed URL, with TIMEOUT
+        seconds for connecting and every read"""
+        key = (url.scheme, url.hostname, url.port)
+        conn = None
+        with self.lock:
+            if self.idle.get(key):
+                conn = self.idle[key].pop()
+        if conn is not None:
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            return conn, True
+        if url.scheme == "https":
+            context = ssl.create_default_context(cafile = cafile)
+            return httplib.HTTPSConnection(url.hostname, url.port,
+                                           timeout = timeout,
+                                           context = context), False
+        return httplib.HTTPConnection(url.hostname, url.port,
+                                      timeout = timeout), False
+
+    def put(self, url, conn):
+        key = (url.scheme, url.hostname, url.port)
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.maxIdle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def closeAll(self):
+        with self.lock:
+            for idle in self.idle.values():
+                for conn in idle:
+                    conn.close()
+            self.idle = {}
+
+connectionPool = ConnectionPool()
 
 class OFXClient:
-    """Encapsulate an ofx client, config is a dict containg configuration"""
-    def __init__(self, config, user, password):
+    """Encapsulate an ofx client, config is a dict containg configuration.
+    UIDGEN makes the NEWFILEUID and TRNUID of requests, a random UUID
+    by default. Queries are built once per kind into a template, later
+    queries only fill in dates, UIDs and the cookie"""
+    def __init__(self, config, user, password, uidgen = _genuuid):
         self.password = password
         self.user = user
         self.config = config
+        self.uidgen = uidgen
+        # None to open a new connection for every query
+        self.pool = connectionPool
+        # requests made, including retries
+        self.attempts = 0
+        # None to build every query from scratch
+        self.templates = {}
         self.cookie = 3
         config["user"] = user
         config["password"] = password
@@ -60,14 +237,14 @@ class OFXClient:
         return str(self.cookie)
 
     """Generate signon message"""
-    def _signOn(self):
+    def _signOn(self, dtclient):
         config = self.config
         fidata = [ _field("ORG",config["fiorg"]) ]
         if config.has_key("fid"):
             fidata += [ _field("FID",config["fid"]) ]
         return _tag("SIGNONMSGSRQV1",
                     _tag("SONRQ",
-                         _field("DTCLIENT",_date()),
+                         _field("DTCLIENT",dtclient),
                          _field("USERID",config["user"]),
                          _field("USERPASS",config["password"]),
                          _field("LANGUAGE","ENG"),
@@ -76,20 +253,20 @@ class OFXClient:
                          _field("APPVER",config["appver"]),
                          ))
 
-    def _acctreq(self, dtstart):
+    def _acctreq(self, dtstart, trnuid, cookie):
         req = _tag("ACCTINFORQ",_field("DTACCTUP",dtstart))
-        return self._message("SIGNUP","ACCTINFO",req)
+        return self._message("SIGNUP","ACCTINFO",req,trnuid,cookie)
 
-    def _ccreq(self, acctid, dtstart):
+    def _ccreq(self, acctid, dtstart, trnuid, cookie):
         config=self.config
         req = _tag("CCSTMTRQ",
                    _tag("CCACCTFROM",_field("ACCTID",acctid)),
                    _tag("INCTRAN",
                         _field("DTSTART",dtstart),
                         _field("INCLUDE","Y")))
-        return self._message("CREDITCARD","CCSTMT",req)
+        return self._message("CREDITCARD","CCSTMT",req,trnuid,cookie)
 
-    def _invstreq(self, brokerid, acctid, dtstart, dtend):
+    def _invstreq(self, brokerid, acctid, dtstart, dtend, trnuid, cookie):
         req = _tag("INVSTMTRQ",
                    _tag("INVACCTFROM",
                       _field("BROKERID", brokerid),
@@ -103,17 +280,17 @@ class OFXClient:
                         _field("DTASOF", dtend),
                         _field("INCLUDE","Y")),
                    _field("INCBAL","Y"))
-        return self._message("INVSTMT","INVSTMT",req)
+        return self._message("INVSTMT","INVSTMT",req,trnuid,cookie)
 
-    def _message(self,msgType,trnType,request):
+    def _message(self,msgType,trnType,request,trnuid,cookie):
         config = self.config
         return _tag(msgType+"MSGSRQV1",
                     _tag(trnType+"TRNRQ",
-                         _field("TRNUID",_genuuid()),
-                         _field("CLTCOOKIE",self._cookie()),
+                         _field("TRNUID",trnuid),
+                         _field("CLTCOOKIE",cookie),
                          request))
     
-    def _header(self):
+    def _header(self, newfileuid):
         return join("\r\n",[ "OFXHEADER:100",
                            "DATA:OFXSGML",
                            "VERSION:102",
@@ -122,59 +299,588 @@ class OFXClient:
                            "CHARSET:1252",
                            "COMPRESSION:NONE",
                            "OLDFILEUID:NONE",
-                           "NEWFILEUID:"+_genuuid(),
+                           "NEWFILEUID:"+newfileuid,
                            ""])
 
+    def _query(self, kind, request, **values):
+        """Query with REQUEST(**VALUES) as message, from the template of
+        KIND. Each value, and the UIDs, cookie and date, is a slot of
+        the template"""
+        values["newfileuid"] = self.uidgen()
+        values["trnuid"] = self.uidgen()
+        values["cookie"] = self._cookie()
+        values["dtclient"] = _date()
+        template = self.templates is not None and self.templates.get(kind)
+        if not template:
+            slots = dict((name, _slot(name)) for name in values.keys())
+            trnuid = slots.pop("trnuid")
+            cookie = slots.pop("cookie")
+            text = join("\r\n",[self._header(slots.pop("newfileuid")),
+                                _tag("OFX",
+                                     self._signOn(slots.pop("dtclient")),
+                                     request(trnuid = trnuid, cookie = cookie,
+                                             **slots))])
+            template = _Template(text)
+            if self.templates is not None:
+                self.templates[kind] = template
+        return template.render(values)
+
     def ccQuery(self, acctid, dtstart):
         """CC Statement request"""
-        return join("\r\n",[self._header(),
-                          _tag("OFX",
-                               self._signOn(),
-                               self._ccreq(acctid, dtstart))])
+        return self._query("CCSTMT", self._ccreq, acctid = acctid,
+                           dtstart = dtstart)
 
     def acctQuery(self,dtstart):
-        return join("\r\n",[self._header(),
-                          _tag("OFX",
-                               self._signOn(),
-                               self._acctreq(dtstart))])
+        return self._query("ACCTINFO", self._acctreq, dtstart = dtstart)
 
     def invstQuery(self, brokerid, acctid, dtstart, dtend):
-        return join("\r\n",[self._header(),
-                          _tag("OFX",
-                               self._signOn(),
-                               self._invstreq(brokerid, acctid,dtstart,dtend))])
-
-    def doQuery(self,query,name):
-        # N.B. urllib doesn't honor user Content-type, use urllib2
-        request = urllib2.Request(self.config["url"],
-                                  query,
-                                  { "Content-type": "application/x-ofx",
-                                    "Accept": "*/*, application/x-ofx"
-                                  })
-        if 1:
-            f = urllib2.urlopen(request)
-            response = f.read()
-            f.close()
-            
-            f = file(name,"w")
-            f.write(response)
+        return self._query("INVSTMT", self._invstreq, brokerid = brokerid,
+                           acctid = acctid, dtstart = dtstart, dtend = dtend)
+
+    def _post(self, query, out):
+        """POST QUERY to the site, reusing a pooled connection when
+        possible, and write the response body to OUT as it arrives.
+        Returns the first CHUNK_SIZE bytes of the body"""
+        url = urlparse(self.config["url"])
+        path = url.path or "/"
+        if url.query:
+            path += "?" + url.query
+        headers = { "Content-type": "application/x-ofx",
+                    "Accept": "*/*, application/x-ofx" }
+        pool = self.pool or ConnectionPool(0)
+        while True:
+            conn, reused = pool.get(url, self.config.get("cafile"),
+                                    float(self.config.get("timeout", DEFAULT_TIMEOUT)))
+            try:
+                conn.request("POST", path, query, headers)
+                response = conn.getresponse()
+                break
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                # server may have closed an idle keep-alive connection,
+                # retry those with a new one
+                if not reused:
+                    raise
+        try:
+            if response.status != 200:
+                raise HttpError(self.config["url"], response.status,
+                                response.reason)
+            head = ""
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                if len(head) < CHUNK_SIZE:
+                    head += chunk[:CHUNK_SIZE - len(head)]
+                out.write(chunk)
+        except:
+            # rest of the response is still on the wire
+            conn.close()
+            raise
+        if response.will_close:
+            conn.close()
+        else:
+            pool.put(url, conn)
+        return head
+
+    def doQuery(self, query, name, sink = None):
+        """Send QUERY and save the response as file NAME. The response
+        is streamed to a temporary file next to NAME, which replaces
+        NAME only once the download is complete. Every chunk is also
+        written to SINK if given, e.g. a parser fed while downloading.
+        With NAME None the response only goes to SINK.
+
+        Network errors, HTTP 5xx and OFX STATUS codes in
+        RETRY_STATUS_CODES are retried up to the site's "retries" times
+        with exponential backoff, SINK is truncated before a retry.
+        Other errors raise HttpError or OfxError"""
+        config = self.config
+        retries = int(config.get("retries", DEFAULT_RETRIES))
+        backoff = float(config.get("backoff", DEFAULT_BACKOFF))
+        limiter = rateLimiter(config)
+        attempt = 0
+        while True:
+            if limiter is not None:
+                limiter.acquire()
+            self.attempts += 1
+            try:
+                self._download(query, name, sink)
+                return
+            except Exception, e:
+                if attempt >= retries or not isTransient(e):
+                    raise
+            time.sleep(backoffDelay(attempt, backoff))
+            attempt += 1
+            if sink is not None:
+                sink.seek(0)
+                sink.truncate()
+
+    def _download(self, query, name, sink):
+        if name is None:
+            checkStatus(self._post(query, sink))
+            return
+        fd, tmpName = tempfile.mkstemp(prefix = os.path.basename(name) + ".",
+                                       dir = os.path.dirname(name) or ".")
+        out = os.fdopen(fd, "wb")
+        try:
+            checkStatus(self._post(query, sink is None and out or _Tee(out, sink)))
+            out.close()
+            os.rename(tmpName, name)
+        except:
+            out.close()
+            os.remove(tmpName)
+            raise
+
+class _Tee:
+    def __init__(self, *outs):
+        self.outs = outs
+
+    def write(self, data):
+        for out in self.outs:
+            out.write(data)
+
+def siteQuery(client, site, account, dtstart, dtend):
+    """Query downloading ACCOUNT from SITE, or list of accounts if
+    ACCOUNT is None"""
+    config = client.config
+    if account is None:
+        return client.acctQuery("19700101000000")
+    elif "CCSTMT" in config["caps"]:
+        return client.ccQuery(account, dtstart)
+    elif "INVSTMT" in config["caps"]:
+        return client.invstQuery(config.get("brokerid", config["fiorg"]),
+                                 account, dtstart, dtend)
+    raise Exception("Site %s can not download account statements" % site)
+
+class BatchJob:
+    """One download of a batch, a line of the jobs file. DTSTART and
+    DTEND override the dates of the batch"""
+    def __init__(self, site, user, account = None, dtstart = None, dtend = None):
+        if not sites.has_key(site):
+            raise Exception("Unknown site %s" % site)
+        self.site = site
+        self.user = user
+        self.account = account
+        self.dtstart = dtstart
+        self.dtend = dtend
+        self.host = urlparse(sites[site]["url"]).netloc
+        self.status = "PENDING"
+        self.seconds = None
+        self.fileName = None
+        self.data = None
+        self.error = None
+        self.attempts = 0
+        self.transient = False
+
+    def __str__(self):
+        return "%s:%s:%s" % (self.site, self.user, self.account or "ACCTINFO")
+
+    def run(self, password, dtstart, dtend, outDir, keepData = False):
+        """Download into OUTDIR, or only into memory if it is None. With
+        KEEPDATA the response is kept in self.data"""
+        # OFXClient stores user and password in the config, so every
+        # job gets its own copy of the site config
+        client = OFXClient(dict(sites[self.site]), self.user, password)
+        if self.account is None:
+            name = "%s_%s_acct.ofx" % (self.site, self.user)
+        else:
+            name = "%s_%s_%s.ofx" % (self.site, self.account, dtend)
+        if outDir is not None:
+            self.fileName = os.path.join(outDir, name)
+        start = time.time()
+        try:
+            query = siteQuery(client, self.site, self.account, dtstart, dtend)
+            if keepData or outDir is None:
+                data = StringIO()
+                client.doQuery(query, self.fileName, data)
+                self.data = data.getvalue()
+            else:
+                client.doQuery(query, self.fileName)
+            self.status = "OK"
+        except Exception, e:
+            self.status = "FAILED"
+            self.error = "%s: %s" % (e.__class__.__name__, e)
+            self.transient = isTransient(e)
+        self.seconds = time.time() - start
+        self.attempts = client.attempts
+
+    def head(self):
+        """Beginning of the downloaded response"""
+        if self.data is not None:
+            return self.data[:CHUNK_SIZE]
+        return open(self.fileName).read(CHUNK_SIZE)
+
+class Watermarks:
+    """Date up to which each (site, account) has been downloaded, kept
+    in a JSON file, so the next download can start from there instead
+    of re-fetching a fixed window"""
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.lock = threading.Lock()
+        if os.path.exists(fileName):
+            self.marks = json.load(open(fileName))
+        else:
+            self.marks = {}
+
+    def _key(self, site, account):
+        return "%s:%s" % (site, account)
+
+    def dtstart(self, site, account, default, dtend, overlap = 3):
+        """Start date for the next download of ACCOUNT up to DTEND,
+        OVERLAP days before its watermark, or DEFAULT if it was never
+        downloaded or the watermark is not before DTEND"""
+        mark = self.marks.get(self._key(site, account))
+        if mark is None:
+            return default
+        start = datetime.strptime(mark[:8], "%Y%m%d") - timedelta(days = overlap)
+        start = start.strftime("%Y%m%d")
+        if start >= dtend[:8]:
+            return default
+        return start
+
+    def update(self, site, account, dtend, response):
+        """Record a successful download up to DTEND, or the server
+        time of RESPONSE, its beginning is enough, if that is earlier.
+        Never moves a watermark back, e.g. when an old month is
+        downloaded"""
+        mark = dtend[:8]
+        dtserver = serverDate(response)
+        if dtserver is not None:
+            mark = min(mark, dtserver)
+        with self.lock:
+            key = self._key(site, account)
+            self.marks[key] = max(mark, self.marks.get(key, ""))
+            tmpName = self.fileName + ".tmp"
+            f = open(tmpName, "w")
+            json.dump(self.marks, f, indent = 1, sort_keys = True)
             f.close()
-	else:
-            print request
-            print self.config["url"], query
-        
-        # ...
+            os.rename(tmpName, self.fileName)
+
+def serverDate(response):
+    """DTSERVER date of a downloaded response, None if there is none"""
+    match = re.search(r"<DTSERVER>\s*(\d{8})", response)
+    return match and match.group(1)
+
+def readJobs(fileName):
+    """Read batch jobs, one <site> <username> [<account>] per line"""
+    jobs = []
+    for line in open(fileName):
+        fields = line.split("#")[0].split()
+        if len(fields) == 0:
+            continue
+        if len(fields) > 3:
+            raise Exception("Bad job line: %s" % line.strip())
+        jobs.append(BatchJob(*fields))
+    return jobs
+
+def runBatch(jobs, passwords, dtstart, dtend, workers = 4, perHost = 2,
+             outDir = ".", report = sys.stdout, watermarks = None, overlap = 3,
+             keepData = False, done = None):
+    """Run JOBS with WORKERS threads, at most PERHOST of them talking
+    to the same server at a time. PASSWORDS is keyed by (site, user).
+    With WATERMARKS statements start OVERLAP days before the previous
+    download of the account instead of at DTSTART. Each job is
+    reported as it finishes, and passed to DONE if given"""
+    hostSlots = {}
+    for job in jobs:
+        if not hostSlots.has_key(job.host):
+            hostSlots[job.host] = threading.Semaphore(perHost)
+    pending = Queue.Queue()
+    for job in jobs:
+        pending.put(job)
+    reportLock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                job = pending.get_nowait()
+            except Queue.Empty:
+                return
+            # DONE hears of every job, even if something here raises
+            try:
+                start, end = job.dtstart or dtstart, job.dtend or dtend
+                if watermarks is not None and job.account is not None:
+                    start = watermarks.dtstart(job.site, job.account, start, end,
+                                               overlap)
+                with hostSlots[job.host]:
+                    job.run(passwords[(job.site, job.user)], start, end, outDir,
+                            keepData)
+                if watermarks is not None and job.account is not None and job.status == "OK":
+                    watermarks.update(job.site, job.account, end, job.head())
+                with reportLock:
+                    print >> report, "%-40s %-6s %7.2fs %s" % (
+                        job, job.status, job.seconds, job.error or job.fileName or "")
+                    report.flush()
+            finally:
+                if done is not None:
+                    done(job)
+
+    threads = [threading.Thread(target = worker)
+               for i in range(min(workers, len(jobs)))]
+    for t in threads:
+        t.setDaemon(True)
+        t.start()
+    for t in threads:
+        t.join()
+    return jobs
+
+def dateWindows(dtstart, dtend, days):
+    """Split DTSTART..DTEND into windows of DAYS days. Consecutive
+    windows share their boundary day, servers differ on whether DTEND
+    is inclusive and the merge drops the duplicates"""
+    start = datetime.strptime(dtstart[:8], "%Y%m%d")
+    end = datetime.strptime(dtend[:8], "%Y%m%d")
+    windows = []
+    while True:
+        last = min(start + timedelta(days = days), end)
+        windows.append((start.strftime("%Y%m%d"), last.strftime("%Y%m%d")))
+        if last >= end:
+            return windows
+        start = last
+
+_tranList = re.compile(r"<INVTRANLIST>(.*?)</INVTRANLIST>\s*", re.S)
+_listDate = re.compile(r"<(DTSTART|DTEND)>([^<\r\n]*)(</\1>)?\s*")
+_aggregate = re.compile(r"<([A-Z0-9.]+)>")
+_fitid = re.compile(r"<FITID>\s*([^<\r\n]+)")
+_secList = re.compile(r"<SECLIST>(.*?)</SECLIST>\s*", re.S)
+_uniqueId = re.compile(r"<(UNIQUEID|UNIQUEIDTYPE)>\s*([^<\r\n]+)")
+
+def _aggregates(body, pos, listName):
+    """Split BODY from POS on into the aggregates it consists of"""
+    aggregates = []
+    while pos < len(body) and body[pos].isspace():
+        pos += 1
+    while pos < len(body):
+        match = _aggregate.match(body, pos)
+        if match is None:
+            raise Exception("Unexpected %s content: %r" % (listName, body[pos:pos + 40]))
+        close = "</%s>" % match.group(1)
+        end = body.index(close, match.end()) + len(close)
+        aggregates.append(body[pos:end])
+        pos = end
+        while pos < len(body) and body[pos].isspace():
+            pos += 1
+    return aggregates
+
+def _transactions(tranList):
+    """Split the body of an INVTRANLIST into its DTSTART/DTEND dates
+    and its transaction aggregates"""
+    body = tranList.strip()
+    dates = {}
+    pos = 0
+    match = _listDate.match(body, pos)
+    while match is not None:
+        dates[match.group(1)] = match.group(2)
+        pos = match.end()
+        match = _listDate.match(body, pos)
+    return dates, _aggregates(body, pos, "INVTRANLIST")
+
+def _securityKey(security):
+    """UNIQUEIDTYPE:UNIQUEID of a SECLIST entry, from its SECINFO,
+    which comes before the underlying's SECID of an OPTINFO"""
+    ids = {}
+    for match in _uniqueId.finditer(security):
+        ids.setdefault(match.group(1), match.group(2).strip())
+    return "%s:%s" % (ids.get("UNIQUEIDTYPE"), ids.get("UNIQUEID"))
+
+def mergeStatements(fileNames, name):
+    """Merge investment statements of consecutive date windows, oldest
+    first, into statement file NAME. Transactions of all windows are
+    kept once per FITID. The security list has the securities of all
+    windows, as the newest window describes them if it does, so older
+    transactions in securities that are gone, like expired options,
+    can still be imported. Everything else, positions and balances,
+    comes from the newest statement"""
+    dates = []
+    transactions = []
+    seen = set()
+    securities = {}
+    securityKeys = []
+    for fileName in fileNames:
+        data = open(fileName).read()
+        match = _secList.search(data)
+        if match is not None:
+            for security in _aggregates(match.group(1), 0, "SECLIST"):
+                key = _securityKey(security)
+                if not securities.has_key(key):
+                    securityKeys.append(key)
+                securities[key] = security
+        match = _tranList.search(data)
+        if match is None:
+            continue
+        listDates, listTransactions = _transactions(match.group(1))
+        dates.append(listDates)
+        for transaction in listTransactions:
+            fitid = _fitid.search(transaction)
+            if fitid is not None:
+                if fitid.group(1) in seen:
+                    continue
+                seen.add(fitid.group(1))
+            transactions.append(transaction)
+    tranList = "\r\n".join(["<INVTRANLIST>"] +
+                            ["<%s>%s</%s>" % (tag, dates[i][tag], tag)
+                             for tag, i in (("DTSTART", 0), ("DTEND", -1))
+                             if dates and dates[i].has_key(tag)] +
+                            transactions + ["</INVTRANLIST>", ""])
+    statement = open(fileNames[-1]).read()
+    if _tranList.search(statement):
+        statement = _tranList.sub(lambda m: tranList, statement, 1)
+    elif "</INVACCTFROM>" not in statement:
+        raise Exception("%s is not an investment statement" % fileNames[-1])
+    else:
+        pos = statement.index("</INVACCTFROM>") + len("</INVACCTFROM>")
+        statement = statement[:pos] + "\r\n" + tranList + statement[pos:].lstrip()
+    if securities:
+        secList = "\r\n".join(["<SECLIST>"] +
+                                [securities[key] for key in securityKeys] +
+                                ["</SECLIST>", ""])
+        if _secList.search(statement):
+            statement = _secList.sub(lambda m: secList, statement, 1)
+        else:
+            pos = statement.rindex("</OFX>")
+            statement = statement[:pos] + "<SECLISTMSGSRSV1>\r\n" + secList + \
+                        "</SECLISTMSGSRSV1>\r\n" + statement[pos:]
+    fd, tmpName = tempfile.mkstemp(prefix = os.path.basename(name) + ".",
+                                   dir = os.path.dirname(name) or ".")
+    out = os.fdopen(fd, "wb")
+    out.write(statement)
+    out.close()
+    os.rename(tmpName, name)
+    return len(transactions)
+
+def backfill(site, user, password, account, dtstart, dtend, name,
+             windowDays = 90, workers = 4, perHost = 2, retries = 2,
+             outDir = ".", report = sys.stdout):
+    """Download ACCOUNT from DTSTART to DTEND in windows of WINDOWDAYS
+    days, WORKERS at a time, and merge them into statement file NAME.
+    Windows that failed with a transient error even after the retries
+    of doQuery get RETRIES more tries. Returns the number of
+    transactions in the merged statement"""
+    jobs = [BatchJob(site, user, account, start, end)
+            for start, end in dateWindows(dtstart, dtend, windowDays)]
+    pending = jobs
+    for attempt in range(retries + 1):
+        runBatch(pending, {(site, user): password}, dtstart, dtend, workers,
+                 perHost, outDir, report)
+        pending = [job for job in pending if job.status != "OK"]
+        if len(pending) == 0 or not all(job.transient for job in pending):
+            break
+    if len(pending) > 0:
+        raise Exception("%d of %d windows failed, %s: %s" % (
+            len(pending), len(jobs), pending[0], pending[0].error))
+    count = mergeStatements([job.fileName for job in jobs], name)
+    for job in jobs:
+        os.remove(job.fileName)
+    return count
+
+def downloadAndImport(jobs, passwords, dtstart, dtend, gnuCashFileName,
+                      workers = 4, perHost = 2, outDir = None,
+                      dontSave = False, adjustPositions = False,
+                      report = sys.stdout, watermarks = None, overlap = 3,
+                      verbosity = 0):
+    """Download the statements of JOBS like runBatch and import each
+    into GNUCASHFILENAME as soon as it arrives, while the others are
+    still downloading. Responses stay in memory, OUTDIR keeps a copy.
+    The book is saved once, after the last statement, and not at all
+    if a statement failed to import, since it could be half applied.
+    Statements after the failed one are not imported. WATERMARKS are
+    only moved for statements imported into the saved book. The
+    importer logs like importOfx.py with VERBOSITY of its -q/-v"""
+    import importOfx
+    importOfx.setupLogging(verbosity)
+    if watermarks is not None:
+        for job in jobs:
+            if job.account is not None:
+                job.dtstart = watermarks.dtstart(job.site, job.account,
+                                                 job.dtstart or dtstart,
+                                                 job.dtend or dtend, overlap)
+    finished = Queue.Queue()
+    downloads = threading.Thread(target = runBatch,
+                                 args = (jobs, passwords, dtstart, dtend,
+                                         workers, perHost, outDir, report,
+                                         None, overlap, True, finished.put))
+    downloads.setDaemon(True)
+    downloads.start()
+    session = importOfx.openSession(gnuCashFileName)
+    imported = []
+    failed = None
+    try:
+        remaining = len(jobs)
+        while remaining > 0:
+            try:
+                job = finished.get(True, 1.0)
+            except Queue.Empty:
+                if downloads.is_alive():
+                    continue
+                # the downloads ended without finishing every job
+                try:
+                    job = finished.get_nowait()
+                except Queue.Empty:
+                    break
+            remaining -= 1
+            if job.status != "OK" or job.account is None:
+                continue
+            start = time.time()
+            if failed is not None:
+                job.status = "NOT IMPORTED"
+                job.error = "%s failed to import before" % failed
+            else:
+                try:
+                    statement = importOfx.parseOfxData(job.data, useCache = False)
+                    importOfx.importStatement(statement, adjustPositions)
+                    job.status = "IMPORTED"
+                    imported.append((job, job.head()))
+                except Exception, e:
+                    importOfx.log.exception("Importing %s failed", job)
+                    job.status = "IMPORT FAILED"
+                    job.error = "%s: %s" % (e.__class__.__name__, e)
+                    failed = job
+            job.data = None
+            print >> report, "%-40s %-6s %7.2fs %s" % (
+                job, job.status, time.time() - start, job.error or "")
+            report.flush()
+        if failed is not None:
+            print >> report, "GnuCash file was not saved, %s failed to import" % failed
+        elif not dontSave:
+            session.save()
+            if watermarks is not None:
+                for job, head in imported:
+                    watermarks.update(job.site, job.account, job.dtend or dtend, head)
+    finally:
+        session.end()
+    return jobs
 
 import getpass
 if __name__=="__main__":
 
     parser = argparse.ArgumentParser(description="Download OFX file from an institution")
-    parser.add_argument('site', metavar='site', help='One of ameritrade, ucard or discover')
-    parser.add_argument('username', metavar='<username>')
+    parser.add_argument('site', metavar='site', nargs='?', help='One of %s' % ', '.join(sorted(sites.keys())))
+    parser.add_argument('username', metavar='<username>', nargs='?')
     parser.add_argument('account', nargs='?', metavar='<account>')
     parser.add_argument('-d', dest='ndays', type=int, default=31, help='Number of days to download')
     parser.add_argument('-m', dest='month', type=int, help='month')
+    parser.add_argument('-I', dest='gnuCashFile', metavar='<gnucash file>', help='Import the downloaded statements into this GnuCash file, without writing them to disk unless -o is given')
+    parser.add_argument('-n', dest='dontSave', action='store_true', help='With -I, dry run (do not save the GnuCash file)')
+    verbosity = parser.add_mutually_exclusive_group()
+    verbosity.add_argument('-q', dest='verbosity', action='store_const', const=-1, default=0, help='With -I, only print warnings of the importer')
+    verbosity.add_argument('-v', dest='verbosity', action='store_const', const=1, help='With -I, also print each transaction as it is imported')
+    parser.add_argument('--sites', dest='sitesFile', metavar='<config file>', help='Read more site definitions from this file, see ofxsites.ini')
+    parser.add_argument('-B', dest='jobsFile', metavar='<jobs file>', help='Batch mode, download every <site> <username> [<account>] line of the file concurrently')
+    parser.add_argument('-j', dest='workers', type=int, default=4, help='Number of concurrent downloads in batch mode')
+    parser.add_argument('--per-host', dest='perHost', type=int, default=2, help='Max concurrent downloads from one server in batch mode')
+    parser.add_argument('-o', dest='outDir', help='Directory for downloaded files in batch mode, default current directory')
+    parser.add_argument('--backfill', metavar='<days>', type=int, help='Download the -d/-m range in windows of <days> days concurrently and merge them into one statement')
+    parser.add_argument('--retries', type=int, default=2, help='Times to retry a failed --backfill window')
+    parser.add_argument('--incremental', action='store_true', help='Download statements only since the previous download of the account, instead of the -d/-m window')
+    parser.add_argument('--overlap', type=int, default=3, help='Days before the previous download to start an incremental download')
+    parser.add_argument('--state', dest='stateFile', default=os.path.expanduser('~/.ofx_watermarks.json'), help='File remembering previous downloads for --incremental')
     args = parser.parse_args()
+    if args.sitesFile is not None:
+        loadSites(args.sitesFile, sites)
+    if args.jobsFile is None and (args.site is None or args.username is None):
+        parser.error("site and username are required unless -B is given")
+    if args.site is not None and not sites.has_key(args.site):
+        parser.error("unknown site %s" % args.site)
 
     if args.month is not None:
       dtstart = datetime.now().replace( month = args.month, day = 1)
@@ -185,15 +891,53 @@ if __name__=="__main__":
       dtstart = time.strftime("%Y%m%d",time.localtime(time.time()-args.ndays*86400))
       dtend = time.strftime("%Y%m%d",time.localtime())
     # print "dtstart=%s dtend=%s" % (dtstart, dtend)
+    watermarks = None
+    if args.incremental:
+        watermarks = Watermarks(args.stateFile)
+    if args.jobsFile is not None or args.gnuCashFile is not None:
+        if args.jobsFile is not None:
+            jobs = readJobs(args.jobsFile)
+        else:
+            jobs = [BatchJob(args.site, args.username, args.account)]
+        passwords = {}
+        for job in jobs:
+            if not passwords.has_key((job.site, job.user)):
+                passwords[(job.site, job.user)] = getpass.getpass(
+                    "Password for %s at %s: " % (job.user, job.site))
+        start = time.time()
+        if args.gnuCashFile is not None:
+            downloadAndImport(jobs, passwords, dtstart, dtend, args.gnuCashFile,
+                              args.workers, args.perHost, args.outDir,
+                              args.dontSave, watermarks = watermarks,
+                              overlap = args.overlap, verbosity = args.verbosity)
+        else:
+            runBatch(jobs, passwords, dtstart, dtend, args.workers, args.perHost,
+                     args.outDir or ".", watermarks = watermarks,
+                     overlap = args.overlap)
+        failed = [job for job in jobs if job.status not in ("OK", "IMPORTED")]
+        print "%d jobs, %d failed, %.2fs" % (len(jobs), len(failed), time.time() - start)
+        sys.exit(len(failed) > 0 and 1 or 0)
     passwd = getpass.getpass()
     client = OFXClient(sites[args.site], args.username, passwd)
     if args.account is None:
        query = client.acctQuery("19700101000000")
        client.doQuery(query, args.site+"_acct.ofx") 
     else:
-       if "CCSTMT" in sites[args.site]["caps"]:
-          query = client.ccQuery(args.account, dtstart)
-       elif "INVSTMT" in sites[args.site]["caps"]:
-          query = client.invstQuery(sites[args.site]["fiorg"], args.account, dtstart, dtend)
+       if args.backfill is not None:
+           name = "%s_%s_%s-%s.ofx" % (args.site, args.account, dtstart, dtend)
+           if args.outDir is not None:
+               name = os.path.join(args.outDir, name)
+           count = backfill(args.site, args.username, passwd, args.account,
+                            dtstart, dtend, name, args.backfill, args.workers,
+                            args.perHost, args.retries, args.outDir or ".")
+           print "%d transactions in %s" % (count, name)
+           sys.exit(0)
+       if watermarks is not None:
+           dtstart = watermarks.dtstart(args.site, args.account, dtstart, dtend,
+                                        args.overlap)
+       query = siteQuery(client, args.site, args.account, dtstart, dtend)
        client.doQuery(query, args.site+dtend+".ofx")
+       if watermarks is not None:
+           watermarks.update(args.site, args.account, dtend,
+                             open(args.site+dtend+".ofx").read(CHUNK_SIZE))
 